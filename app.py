@@ -1,6 +1,6 @@
 import os
 import asyncio
-from fastapi import FastAPI,Request
+from fastapi import FastAPI,Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
@@ -8,37 +8,64 @@ from fastapi import BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from routers.invoice import router as invoice_router
 from routers.auth.auth import router as auth_router
-from datetime import datetime, timedelta, timezone
-import time
+from routers.reports import router as reports_router
 
 
-from database import invoicedb as db
-session_collection = db.get_collection("sessions")
+from database import ensure_indexes
+from routers.numbering import seed_invoice_counters, ist_date_string
+from routers.auth.async_frappeclient import close_pool as close_frappe_pool
+from routers.utils import AUTH_MODE
+from routers.revocation import revocation_list
+from routers.backup import backup_catalog
+from routers.pdf import pdf_cache
+from routers.session_cache import session_cache
+from routers.auth.breaker import frappe_breaker
+from routers.coalescer import create_coalescer
+from routers.frappe_sync import FRAPPE_SYNC_ENABLED, frappe_sync
+from metrics import SessionCacheCollector, register_collector, render_metrics
+from middleware import TimingMiddleware, RequestIDMiddleware
 
 
-async def cleanup_expired_sessions():
-    while True:
-        # Delete sessions where the expiration time is less than the current UTC time
-        session_collection.delete_many({"expires_at": {"$lt": datetime.now(timezone.utc)}})
-        
-        # Wait for an hour before checking again
-        await asyncio.sleep(3600)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Background task for cleaning expired sessions
-    task = asyncio.create_task(cleanup_expired_sessions())
+    # expired sessions are removed by the TTL index on sessions.expires_at
+    await ensure_indexes()
+
+    # make sure today's counter is never behind invoices created before the allocator existed
+    await seed_invoice_counters(ist_date_string())
+
+    # load (or build, on first run) the backup catalog without blocking the loop
+    await asyncio.to_thread(backup_catalog.load)
+
+    # index cached invoice PDFs and clear out interrupted downloads
+    await asyncio.to_thread(pdf_cache.load)
+
+    tasks = []
+
+    if AUTH_MODE == "token":
+        # load revocations before serving, then keep this worker in sync
+        await revocation_list.sync()
+        tasks.append(asyncio.create_task(revocation_list.run()))
+
+    if FRAPPE_SYNC_ENABLED:
+        # every worker starts it, the one holding the sync lease does the pushing
+        tasks.append(asyncio.create_task(frappe_sync.run()))
 
     try:
         yield  # Startup phase completed, app is running
     finally:
         # Shutdown phase, clean up tasks
         print("Application shutdown")
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            print("Cleanup task cancelled during shutdown")
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                print("Background task cancelled during shutdown")
+        # creates still waiting for their batch are written before exiting
+        await create_coalescer.drain()
+        await close_frappe_pool()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -72,20 +99,30 @@ app.add_middleware(
 )
 
 
-# every request milli sec
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    return response
+# every request milli sec, and a request id for tracing (pure ASGI, see middleware.py)
+app.add_middleware(TimingMiddleware)
+app.add_middleware(RequestIDMiddleware)
+
+
+register_collector(SessionCacheCollector(session_cache))
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    # Frappe being down only affects login and PDFs, so it is reported, not failed on
+    return {"status": "ok", "frappe": frappe_breaker.snapshot()}
 
 
 
 # Include the invoice router
 app.include_router(invoice_router, prefix="/api/invoices", tags=["invoices"])
 app.include_router(auth_router,prefix="/api/auth",tags=["auth"])
+app.include_router(reports_router, prefix="/api/reports", tags=["reports"])
 
 
 # @app.get("/{rest_of_path:path}")
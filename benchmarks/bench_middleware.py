@@ -0,0 +1,93 @@
+"""Requests per second on the invoice routes with the old @app.middleware("http")
+timing hook (BaseHTTPMiddleware) versus the pure ASGI stack in middleware.py.
+
+Both apps mount the same routers and talk to the Mongo at MONGODB_URL, so the
+difference is the middleware alone. Authentication is overridden with a fixed
+admin user to keep session lookups out of the numbers.
+
+    SECRET_KEY=x FRAPPE_URL=http://localhost python -m benchmarks.bench_middleware
+"""
+import asyncio
+import time
+import httpx
+from fastapi import FastAPI, Request
+
+from middleware import TimingMiddleware, RequestIDMiddleware
+from routers.invoice import router as invoice_router
+from routers.utils import get_current_user
+
+ADMIN = {"username": "bench", "email": "bench@example.com", "roles": ["admin"]}
+
+
+def base_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(invoice_router, prefix="/api/invoices")
+    app.dependency_overrides[get_current_user] = lambda: ADMIN
+    return app
+
+
+def legacy_app() -> FastAPI:
+    app = base_app()
+
+    @app.middleware("http")
+    async def add_process_time_header(request: Request, call_next):
+        start_time = time.time()
+        response = await call_next(request)
+        response.headers["X-Process-Time"] = str(time.time() - start_time)
+        return response
+
+    return app
+
+
+def asgi_app() -> FastAPI:
+    app = base_app()
+    app.add_middleware(TimingMiddleware)
+    app.add_middleware(RequestIDMiddleware)
+    return app
+
+
+async def drive(client: httpx.AsyncClient, path: str, requests: int, concurrency: int) -> float:
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            response = await client.get(path)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int = 2000, concurrency: int = 32):
+    apps = {"legacy": legacy_app(), "asgi": asgi_app()}
+    clients = {
+        name: httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+        for name, app in apps.items()
+    }
+    try:
+        created = await clients["asgi"].post("/api/invoices/", json={
+            "name": "Bench", "email": "bench@example.com", "amount": 42.0,
+        })
+        created.raise_for_status()
+        number = created.json()["invoice_number"]
+        paths = {
+            "show": f"/api/invoices/{number}",
+            "paginate": "/api/invoices/get_pagination?limit=50",
+            "stream": "/api/invoices/?stream=ndjson",
+        }
+        for route, path in paths.items():
+            rps = {}
+            for name, client in clients.items():
+                await drive(client, path, requests // 10, concurrency)  # warm up
+                rps[name] = await drive(client, path, requests, concurrency)
+            print(f"{route:<10} legacy {rps['legacy']:8.0f} rps   asgi {rps['asgi']:8.0f} rps   "
+                  f"{rps['asgi'] / rps['legacy']:.2f}x")
+        await clients["asgi"].delete(f"/api/invoices/{number}")
+    finally:
+        for client in clients.values():
+            await client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""Per-request cost of the invoice response path: InvoiceModel validation and
+FastAPI serialization versus MongoJSONResponse on the raw Mongo document, plus
+the MessagePack and raw BSON encodings offered to internal consumers.
+
+    SECRET_KEY=x FRAPPE_URL=http://localhost python -m benchmarks.bench_serialization
+"""
+import timeit
+from datetime import datetime
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from routers.invoice import InvoiceModel, InvoiceCollection, public_invoice
+from routers.responses import MongoJSONResponse, MsgPackResponse, BSONResponse, orjson, msgpack
+
+
+def make_doc(i: int) -> dict:
+    return {
+        "_id": ObjectId(),
+        "invoice_number": f"INV-22-02-2023-{i:04d}",
+        "name": "John Doe",
+        "email": "johndoe@example.com",
+        "amount": 100.5 + i,
+        "created_at": datetime(2023, 2, 22, 10, 0, 0, 123000),
+    }
+
+
+def pydantic_path(adapter, value):
+    # what FastAPI does for response_model routes: validate, dump in json mode, json.dumps
+    validated = adapter.validate_python(value)
+    return JSONResponse(adapter.dump_python(validated, mode="json", by_alias=False)).body
+
+
+def main(repeat: int = 5):
+    single = make_doc(1)
+    page = [make_doc(i) for i in range(1000)]
+    raw_page = [RawBSONDocument(bson.encode(doc)) for doc in page]
+    invoice_adapter = TypeAdapter(InvoiceModel)
+    collection_adapter = TypeAdapter(InvoiceCollection)
+
+    cases = {
+        "single/pydantic": (lambda: pydantic_path(invoice_adapter, single), 20000),
+        "single/fast": (lambda: MongoJSONResponse(public_invoice(single)).body, 20000),
+        "list-1000/pydantic": (lambda: pydantic_path(collection_adapter, {"invoices": page}), 20),
+        "list-1000/fast": (lambda: MongoJSONResponse({"invoices": [public_invoice(d) for d in page]}).body, 20),
+        # what Motor hands back with RawBSONDocument: the bytes are passed through untouched
+        "list-1000/raw-bson": (lambda: BSONResponse(b"".join(d.raw for d in raw_page)).body, 200),
+    }
+    if msgpack is not None:
+        cases["single/msgpack"] = (lambda: MsgPackResponse(public_invoice(single)).body, 20000)
+        cases["list-1000/msgpack"] = (lambda: MsgPackResponse({"invoices": [public_invoice(d) for d in page]}).body, 20)
+    print(f"encoder: {'orjson' if orjson else 'json'}")
+    results = {}
+    for name, (func, number) in cases.items():
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        results[name] = best
+        print(f"{name:<22} {best * 1e6:10.1f} us/op")
+    for case in ("single", "list-1000"):
+        print(f"{case}: {results[f'{case}/pydantic'] / results[f'{case}/fast']:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
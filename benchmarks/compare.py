@@ -0,0 +1,58 @@
+"""Compare two load test results and flag latency or throughput regressions.
+
+    python -m benchmarks.compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+
+Exits with 1 when any route's p95 grows, or its throughput drops, by more than
+--threshold percent.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(base: dict, head: dict, threshold: float) -> list:
+    regressions = []
+    print(f"{base['revision']} -> {head['revision']}")
+    print(f"{'route':<10}" + "".join(f"{metric:>24}" for metric in METRICS))
+    for route, head_stats in head["routes"].items():
+        base_stats = base["routes"].get(route)
+        if base_stats is None:
+            continue
+        cells = []
+        for metric in METRICS:
+            delta = change(base_stats[metric], head_stats[metric])
+            cells.append(f"{base_stats[metric]:>9.2f} -> {head_stats[metric]:>7.2f} {delta:+5.0f}%")
+        print(f"{route:<10}" + "".join(f"{cell:>24}" for cell in cells))
+        if change(base_stats["p95_ms"], head_stats["p95_ms"]) > threshold:
+            regressions.append(f"{route}: p95 {base_stats['p95_ms']:.2f}ms -> {head_stats['p95_ms']:.2f}ms")
+        if -change(base_stats["throughput_rps"], head_stats["throughput_rps"]) > threshold:
+            regressions.append(f"{route}: throughput {base_stats['throughput_rps']:.1f} -> {head_stats['throughput_rps']:.1f} rps")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base", type=Path)
+    parser.add_argument("head", type=Path)
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent")
+    args = parser.parse_args()
+
+    base = json.loads(args.base.read_text())
+    head = json.loads(args.head.read_text())
+    regressions = compare(base, head, args.threshold)
+    if regressions:
+        print("\nregressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
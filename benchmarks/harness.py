@@ -0,0 +1,241 @@
+"""Throwaway stack for load tests and the end-to-end test: a Mongo, a fake Frappe
+and the app under uvicorn, all on free local ports.
+
+Mongo is an ephemeral mongod in a temporary dbpath when `mongod` is on PATH.
+Otherwise BENCH_MONGODB_URL must point at a disposable server. The app always
+uses the `invoicedb` database, so never point this at real data.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FAKE_PASSWORD = "bench"
+FAKE_ROLES = ["admin"]
+FAKE_PDF_SIZE = 200 * 1024  # padding, so a PDF spans several chunks
+
+
+class StackUnavailable(RuntimeError):
+    pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def port_open(port: int) -> bool:
+    with socket.create_connection(("127.0.0.1", port), 0.5):
+        return True
+
+
+def wait_until(check, timeout: float, what: str, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise StackUnavailable(f"{what} exited with code {process.returncode}")
+        try:
+            if check():
+                return
+        except (OSError, httpx.HTTPError):
+            pass
+        time.sleep(0.1)
+    raise StackUnavailable(f"{what} did not come up within {timeout:.0f}s")
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def mongo_available() -> bool:
+    return bool(os.environ.get("BENCH_MONGODB_URL") or shutil.which("mongod"))
+
+
+@contextmanager
+def mongo_server():
+    '''Yields a MongoDB URL: BENCH_MONGODB_URL, or an ephemeral mongod'''
+    url = os.environ.get("BENCH_MONGODB_URL")
+    if url:
+        yield url
+        return
+    mongod = shutil.which("mongod")
+    if mongod is None:
+        raise StackUnavailable("mongod is not on PATH and BENCH_MONGODB_URL is not set")
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="bench-mongo-") as dbpath:
+        process = subprocess.Popen(
+            [mongod, "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until(lambda: port_open(port), 30, "mongod", process)
+            yield f"mongodb://127.0.0.1:{port}/"
+        finally:
+            stop(process)
+
+
+class FakeFrappeHandler(BaseHTTPRequestHandler):
+    '''The slice of Frappe the app talks to: login, logout, User docs, PDFs and
+    the document writes of the invoice sync (kept in memory on the server)'''
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+
+    def do_POST(self):
+        time.sleep(self.server.delay)
+        form = self.read_form()
+        url = urlsplit(self.path)
+        docs = self.server.docs
+        if url.path.startswith("/api/resource/"):
+            doc = json.loads(form["data"])
+            with self.server.lock:
+                if doc["name"] in docs:
+                    return self.reply(409, {"exc": f"DuplicateEntryError: {doc['name']}"})
+                docs[doc["name"]] = doc
+            return self.reply(200, {"data": doc})
+        if form.get("cmd") == "frappe.client.insert_many":
+            batch = json.loads(form["docs"])
+            with self.server.lock:
+                # all or nothing, like Frappe's request transaction
+                if duplicates := [doc["name"] for doc in batch if doc["name"] in docs]:
+                    return self.reply(409, {"exc": f"DuplicateEntryError: {duplicates[0]}"})
+                docs.update((doc["name"], doc) for doc in batch)
+            return self.reply(200, {"message": [doc["name"] for doc in batch]})
+        if form.get("cmd") == "frappe.client.bulk_update":
+            failed = []
+            with self.server.lock:
+                for doc in json.loads(form["docs"]):
+                    if doc["docname"] in docs:
+                        docs[doc["docname"]].update(doc)
+                    else:
+                        failed.append({"doc": doc, "exc": "DoesNotExistError"})
+            return self.reply(200, {"message": {"failed_docs": failed}})
+        if form.get("cmd") != "login":
+            return self.reply(404, {"exc": "unknown command"})
+        if form.get("pwd") != FAKE_PASSWORD:
+            return self.reply(401, {"message": "Incorrect password"})
+        self.reply(200, {"message": "Logged In", "full_name": form.get("usr")},
+                   {"Set-Cookie": "sid=fake; Path=/"})
+
+    def do_PUT(self):
+        time.sleep(self.server.delay)
+        doc = json.loads(self.read_form()["data"])
+        name = unquote(urlsplit(self.path).path.rsplit("/", 1)[1])
+        with self.server.lock:
+            if name not in self.server.docs:
+                return self.reply(404, {"exc": f"DoesNotExistError: {name}"})
+            self.server.docs[name].update(doc)
+        self.reply(200, {"data": self.server.docs[name]})
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") == "/api/method/frappe.auth.get_logged_user":
+            return self.reply(200, {"message": "Administrator"})
+        if parse_qs(url.query).get("cmd") == ["logout"]:
+            return self.reply(200, {})
+        prefix = "/api/resource/User/"
+        if url.path.startswith(prefix):
+            username = url.path[len(prefix):]
+            return self.reply(200, {"data": {
+                "name": username,
+                "username": username,
+                "email": f"{username}@example.com",
+                "roles": [{"role": role} for role in FAKE_ROLES],
+            }})
+        if url.path == "/api/method/frappe.templates.pages.print.download_pdf":
+            name = parse_qs(url.query).get("name", [""])[0]
+            body = b"%PDF-1.4\n% " + name.encode() + b"\n" + b"0" * FAKE_PDF_SIZE + b"\n%%EOF\n"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path.startswith("/api/resource/"):
+            name = unquote(url.path.rsplit("/", 1)[1])
+            if name in self.server.docs:
+                return self.reply(200, {"data": self.server.docs[name]})
+        self.reply(404, {"exc": f"no route for {url.path}"})
+
+
+@contextmanager
+def fake_frappe(delay: float = 0.0):
+    '''Yields the URL of a threaded fake Frappe; `delay` is added to every response'''
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), FakeFrappeHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.docs = {}  # documents written through the API, by name
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def app_server(mongodb_url: str, frappe_url: str, workers: int = 1, env: dict = None):
+    '''Runs app:app under uvicorn in a subprocess and yields its base URL'''
+    port = free_port()
+    environ = {
+        **os.environ,
+        "SECRET_KEY": os.environ.get("SECRET_KEY", "bench-secret"),
+        "MONGODB_URL": mongodb_url,
+        "FRAPPE_URL": frappe_url,
+        **(env or {}),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=REPO_ROOT, env=environ,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until(lambda: httpx.get(base_url + "/metrics", timeout=1).is_success, 60, "uvicorn", process)
+        yield base_url
+    finally:
+        stop(process)
+
+
+@contextmanager
+def stack(workers: int = 1, frappe_delay: float = 0.0, env: dict = None):
+    '''Mongo, fake Frappe and the app together; yields the app's base URL'''
+    with mongo_server() as mongodb_url, fake_frappe(frappe_delay) as frappe_url:
+        with app_server(mongodb_url, frappe_url, workers, env) as base_url:
+            yield base_url
@@ -0,0 +1,165 @@
+"""Load test for the invoice API: every virtual user logs in once, then loops
+create -> get -> update -> list -> paginate -> delete. Reports throughput and
+p50/p95/p99 per route and saves the run as benchmarks/results/<git sha>.json.
+
+    python -m benchmarks.loadtest --concurrency 32 --iterations 50
+    python -m benchmarks.loadtest --base-url http://127.0.0.1:8000   # existing server
+
+Without --base-url the stack from benchmarks/harness.py is started (needs mongod
+on PATH or BENCH_MONGODB_URL). Compare runs with benchmarks/compare.py.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+
+from benchmarks.harness import REPO_ROOT, FAKE_PASSWORD, stack
+
+ROUTES = ("login", "create", "get", "update", "list", "paginate", "delete")
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, route: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.samples[route].append(time.perf_counter() - start)
+        if response.is_error:
+            self.errors[route] += 1
+            return None
+        return response
+
+
+def percentile(sorted_samples: list, pct: float) -> float:
+    # nearest rank
+    index = max(0, min(len(sorted_samples) - 1, round(pct / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    routes = {}
+    for route in ROUTES:
+        samples = sorted(recorder.samples[route])
+        if not samples:
+            continue
+        routes[route] = {
+            "requests": len(samples),
+            "errors": recorder.errors[route],
+            "throughput_rps": len(samples) / elapsed,
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
+    return routes
+
+
+async def virtual_user(client: httpx.AsyncClient, recorder: Recorder, user: int, iterations: int):
+    login = await recorder.call("login", client.post(
+        "/api/auth/", data={"username": f"bench{user}", "password": FAKE_PASSWORD},
+    ))
+    if login is None:
+        return
+    # session mode sets a cookie, token mode also returns the bearer token
+    if token := login.json().get("access_token"):
+        client.headers["Authorization"] = f"Bearer {token}"
+
+    for i in range(iterations):
+        created = await recorder.call("create", client.post("/api/invoices/", json={
+            "name": f"Bench User {user}",
+            "email": f"bench{user}@example.com",
+            "amount": 100 + i,
+        }))
+        if created is None:
+            continue
+        number = created.json()["invoice_number"]
+        await recorder.call("get", client.get(f"/api/invoices/{number}"))
+        await recorder.call("update", client.put(f"/api/invoices/{number}", json={"amount": 200 + i}))
+        await recorder.call("list", client.get("/api/invoices/"))
+        page = await recorder.call("paginate", client.get("/api/invoices/get_pagination", params={"limit": 50}))
+        if page is not None and (cursor := page.json().get("next_cursor")):
+            await recorder.call("paginate", client.get("/api/invoices/get_pagination", params={"limit": 50, "cursor": cursor}))
+        await recorder.call("delete", client.delete(f"/api/invoices/{number}"))
+
+
+async def run_load(base_url: str, concurrency: int, iterations: int) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) for _ in range(concurrency)]
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            virtual_user(client, recorder, user, iterations) for user, client in enumerate(clients)
+        ))
+    finally:
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            await client.aclose()
+    return {"elapsed_s": elapsed, "routes": summarize(recorder, elapsed)}
+
+
+def git_revision() -> str:
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty.strip() else "")
+
+
+def print_report(result: dict):
+    print(f"{'route':<10} {'reqs':>7} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in result["routes"].items():
+        print(f"{route:<10} {stats['requests']:>7} {stats['errors']:>5} {stats['throughput_rps']:>9.1f} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=50, help="lifecycles per virtual user")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers when starting the stack")
+    parser.add_argument("--frappe-delay", type=float, default=0.0, help="seconds added to each fake Frappe response")
+    parser.add_argument("--auth-mode", choices=("session", "token"), default="session")
+    parser.add_argument("--base-url", help="benchmark an already running server instead")
+    parser.add_argument("--output", type=Path, help="defaults to benchmarks/results/<git sha>.json")
+    args = parser.parse_args()
+
+    if args.base_url:
+        result = asyncio.run(run_load(args.base_url, args.concurrency, args.iterations))
+    else:
+        with stack(args.workers, args.frappe_delay, {"AUTH_MODE": args.auth_mode}) as base_url:
+            result = asyncio.run(run_load(base_url, args.concurrency, args.iterations))
+
+    revision = git_revision()
+    result = {
+        "revision": revision,
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        **result,
+    }
+    print_report(result)
+    output = args.output or RESULTS_DIR / f"{revision}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
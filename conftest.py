@@ -0,0 +1,5 @@
+import os
+
+# app modules read these at import time; the unit tests never talk to either
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("FRAPPE_URL", "http://frappe.invalid")
@@ -1,13 +1,156 @@
 import motor.motor_asyncio
 import os
 from decouple import config
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from metrics import MongoCommandListener, MongoPoolListener
 
 # export MONGODB_URL="mongodb://localhost:27017/"
 
 MONGODB_URL = config('MONGODB_URL',default = "mongodb://localhost:27017/")
 
+# connection pool, per uvicorn worker
+MONGO_MAX_POOL_SIZE = config('MONGO_MAX_POOL_SIZE', cast=int, default=100)
+MONGO_MIN_POOL_SIZE = config('MONGO_MIN_POOL_SIZE', cast=int, default=0)
+# how long a request waits for a free connection before failing (0 = forever)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = config('MONGO_WAIT_QUEUE_TIMEOUT_MS', cast=int, default=5000)
+MONGO_MAX_IDLE_TIME_MS = config('MONGO_MAX_IDLE_TIME_MS', cast=int, default=0)
+# wire compression in order of preference, e.g. "zstd,snappy,zlib"; the server picks the first it supports
+MONGO_COMPRESSORS = config('MONGO_COMPRESSORS', default="")
 
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+    }
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    if MONGO_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = MONGO_MAX_IDLE_TIME_MS
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
+
+
+# per-command latency and pool usage for /metrics come from pymongo monitoring
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    MONGODB_URL,
+    event_listeners=[MongoCommandListener(), MongoPoolListener(MONGO_MAX_POOL_SIZE)],
+    **client_options(),
+)
 
 # for invoice table
-invoicedb = client.invoicedb
\ No newline at end of file
+invoicedb = client.invoicedb
+
+
+# Writes, sessions and single-invoice reads always use the primary (the
+# client default). Read-heavy workloads can be pointed at secondaries:
+#   listing   - list_invoices, list_pagination_invoice
+#   analytics - exports and reports
+# e.g. MONGO_ANALYTICS_READ_PREFERENCE=secondaryPreferred. Reads from a
+# secondary can lag behind the latest writes by the replication delay.
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+READ_WORKLOADS = ("listing", "analytics")
+
+
+def read_preference(name: str, max_staleness: int):
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference {name!r}, expected one of {', '.join(READ_PREFERENCES)}")
+    if name == "primary":
+        return Primary()
+    return READ_PREFERENCES[name](max_staleness=max_staleness)
+
+
+def workload_settings(workload: str) -> dict:
+    prefix = f"MONGO_{workload.upper()}"
+    level = config(f"{prefix}_READ_CONCERN", default="local")
+    return {
+        "read_preference": read_preference(
+            config(f"{prefix}_READ_PREFERENCE", default="primary"),
+            # -1 = no limit; otherwise at least 90 seconds, a server requirement
+            config(f"{prefix}_MAX_STALENESS_SECONDS", cast=int, default=-1),
+        ),
+        "read_concern": ReadConcern(level or None),
+    }
+
+
+WORKLOAD_SETTINGS = {workload: workload_settings(workload) for workload in READ_WORKLOADS}
+
+
+def read_collection(name: str, workload: str):
+    '''A handle on `name` that reads with the workload's read preference and concern'''
+    return invoicedb.get_collection(name, **WORKLOAD_SETTINGS[workload])
+
+
+# Indexes the app relies on, created by the lifespan hook in app.py.
+# Adding an index here is enough to have it built on the next deploy.
+MANAGED_INDEXES = {
+    "invoices": [
+        IndexModel([("invoice_number", ASCENDING)], name="invoice_number_unique", unique=True),
+        # sort key for keyset pagination (created_at, _id)
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id"),
+        # filtered listings; routers/search.py hints them by name
+        IndexModel([("email", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="email_created_at"),
+        IndexModel([("name", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="name_created_at"),
+        # sort key first, then the range filters; those are checked on the index keys
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING), ("name", ASCENDING), ("amount", ASCENDING)], name="created_at_filters"),
+        IndexModel([("amount", ASCENDING), ("_id", ASCENDING), ("created_at", ASCENDING), ("name", ASCENDING)], name="amount_filters"),
+        # change feed order for the Frappe sync (routers/frappe_sync.py)
+        IndexModel([("updated_at", ASCENDING), ("_id", ASCENDING)], name="updated_at_id"),
+    ],
+    "invoice_rollups": [
+        IndexModel([("kind", ASCENDING), ("key", ASCENDING)], name="kind_key"),
+    ],
+    "sessions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+        # Mongo removes sessions itself once expires_at has passed
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+
+async def ensure_indexes():
+    errors = {}
+    for collection_name, indexes in MANAGED_INDEXES.items():
+        try:
+            # no-op for indexes that already exist with the same definition
+            await invoicedb[collection_name].create_indexes(indexes)
+        except OperationFailure as exc:
+            # e.g. duplicate invoice numbers blocking a unique index; keep serving
+            print(f"Index creation failed on {collection_name}: {exc}")
+            errors[collection_name] = str(exc)
+    return errors
+
+
+async def index_report():
+    '''Managed indexes that are missing, and indexes with no recorded use'''
+    report = {}
+    for collection_name, indexes in MANAGED_INDEXES.items():
+        collection = invoicedb[collection_name]
+        managed = {index.document["name"] for index in indexes}
+        existing = set(await collection.index_information())
+        usage = {
+            stat["name"]: stat["accesses"]["ops"]
+            async for stat in collection.aggregate([{"$indexStats": {}}])
+        }
+        report[collection_name] = {
+            "missing": sorted(managed - existing),
+            "unmanaged": sorted(existing - managed - {"_id_"}),
+            # counters reset when mongod restarts, so treat this as a hint
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+            "usage": usage,
+        }
+    return report
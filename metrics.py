@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from pymongo import monitoring
+from starlette.routing import Match
+
+# Prometheus metrics served at /metrics. Each uvicorn worker keeps its own
+# registry, so scrape workers individually (or run a single worker per pod).
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests currently being handled",
+    ["method", "route"],
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency",
+    ["command"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongo_command_failures_total", "MongoDB commands that returned an error",
+    ["command"],
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    "mongo_pool_connections", "Open connections in the MongoDB pool",
+    ["address"],
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    "mongo_pool_checked_out", "MongoDB connections currently in use",
+    ["address"],
+)
+MONGO_POOL_UTILIZATION = Gauge(
+    "mongo_pool_utilization", "Checked out MongoDB connections as a fraction of maxPoolSize",
+    ["address"],
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total", "MongoDB connection checkouts that failed (timeout = pool exhausted)",
+    ["address", "reason"],
+)
+FRAPPE_CALL_LATENCY = Histogram(
+    "frappe_call_duration_seconds", "FrappeClient call latency",
+    ["method"],
+)
+FRAPPE_CALL_ERRORS = Counter(
+    "frappe_call_errors_total", "FrappeClient calls that raised",
+    ["method", "error"],
+)
+CREATE_BATCH_SIZE = Histogram(
+    "invoice_create_batch_size", "Invoices written per coalesced insert_many",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+CREATE_BATCH_WAIT = Histogram(
+    "invoice_create_batch_wait_seconds", "Latency added to a create while it waits for its batch",
+    buckets=(.0005, .001, .002, .003, .005, .0075, .01, .025, .05, .1),
+)
+FRAPPE_BREAKER_STATE = Gauge(
+    "frappe_circuit_breaker_state", "Frappe circuit breaker: 0 closed, 1 half open, 2 open",
+)
+FRAPPE_BREAKER_TRANSITIONS = Counter(
+    "frappe_circuit_breaker_transitions_total", "Frappe circuit breaker state changes, by new state",
+    ["state"],
+)
+FRAPPE_BREAKER_REJECTED = Counter(
+    "frappe_circuit_breaker_rejected_total", "Frappe requests failed fast while the breaker was open",
+)
+FRAPPE_RETRIES = Counter(
+    "frappe_request_retries_total", "Idempotent Frappe requests retried, or not retried because the budget was spent",
+    ["result"],
+)
+FRAPPE_SYNC_DOCUMENTS = Counter(
+    "frappe_sync_documents_total", "Invoices pushed to Frappe by the background sync",
+    ["operation", "result"],
+)
+FRAPPE_SYNC_RETRIES = Counter(
+    "frappe_sync_retries_total", "Sync calls retried after Frappe was unreachable or answered with an error page",
+)
+FRAPPE_SYNC_QUEUE_DEPTH = Gauge(
+    "frappe_sync_queue_depth", "Invoices read from Mongo and waiting to be pushed to Frappe",
+)
+SESSION_LOOKUP_LATENCY = Histogram(
+    "session_lookup_duration_seconds", "Time spent authenticating a request",
+    ["source"],
+    buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1),
+)
+
+
+def route_template(scope) -> str:
+    # label by route template (/api/invoices/{invoice_number}) to keep cardinality bounded
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    partial = None
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    '''Tracks open and checked out connections per server'''
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self.checked_out = defaultdict(int)
+        # pymongo calls listeners from whichever thread checks out the connection
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def address(event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def _checked_out(self, event, delta: int):
+        address = self.address(event)
+        with self.lock:
+            self.checked_out[address] = max(0, self.checked_out[address] + delta)
+            in_use = self.checked_out[address]
+        MONGO_POOL_CHECKED_OUT.labels(address).set(in_use)
+        if self.max_pool_size:
+            MONGO_POOL_UTILIZATION.labels(address).set(in_use / self.max_pool_size)
+
+    def connection_checked_out(self, event):
+        self._checked_out(event, 1)
+
+    def connection_checked_in(self, event):
+        self._checked_out(event, -1)
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.labels(self.address(event), event.reason).inc()
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.address(event)).inc()
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.address(event)).dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+def instrument_frappe_calls(*method_names):
+    '''Class decorator timing the named coroutine methods of a Frappe client'''
+    def decorator(cls):
+        for name in method_names:
+            setattr(cls, name, _timed_frappe_call(name, getattr(cls, name)))
+        return cls
+    return decorator
+
+
+def _timed_frappe_call(name, func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as exc:
+            FRAPPE_CALL_ERRORS.labels(name, type(exc).__name__).inc()
+            raise
+        finally:
+            FRAPPE_CALL_LATENCY.labels(name).observe(time.perf_counter() - start)
+    return wrapper
+
+
+class SessionCacheCollector:
+    '''Exposes the session cache counters without double bookkeeping'''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        for name in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(f"session_cache_{name}", f"Session cache {name}", value=stats[name])
+        yield GaugeMetricFamily("session_cache_size", "Sessions currently cached", value=stats["size"])
+
+
+def register_collector(collector):
+    REGISTRY.register(collector)
+
+
+def render_metrics():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,65 @@
+import time
+import uuid
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import REQUEST_LATENCY, REQUESTS_IN_PROGRESS, route_template
+
+# Pure ASGI middleware. Unlike @app.middleware("http") (BaseHTTPMiddleware)
+# these do not run the endpoint in a separate task or pipe the body through a
+# memory stream, so streaming responses (NDJSON, exports, backup downloads)
+# pass straight through. Anything cross-cutting should be added here the same
+# way: wrap `send`, touch only the http.response.start message.
+
+
+class TimingMiddleware:
+    '''Sets X-Process-Time and records the request latency and in-flight metrics'''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        in_progress = REQUESTS_IN_PROGRESS.labels(scope["method"], route)
+        in_progress.inc()
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # time to first byte; the body of a streamed response is still to come
+                MutableHeaders(scope=message)["X-Process-Time"] = str(time.perf_counter() - start_time)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            REQUEST_LATENCY.labels(scope["method"], route, str(status_code)).observe(time.perf_counter() - start_time)
+
+
+class RequestIDMiddleware:
+    '''Propagates X-Request-ID, generating one when the client did not send it'''
+    header = "X-Request-ID"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get(self.header) or uuid.uuid4().hex
+        scope.setdefault("state", {})["request_id"] = request_id
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)[self.header] = request_id
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,433 @@
+import asyncio
+import json
+import random
+import time
+from base64 import b64encode
+from io import BytesIO
+from urllib.parse import quote
+
+import httpx
+from decouple import config
+
+from metrics import FRAPPE_RETRIES, instrument_frappe_calls
+from .breaker import frappe_breaker, frappe_retry_budget
+from .frappeclient import (
+	AuthError, FrappeException, NotUploadableException,
+	FRAPPE_TIMEOUT, FRAPPE_CONNECT_TIMEOUT, FRAPPE_READ_TIMEOUT, FRAPPE_GET_RETRIES,
+	FRAPPE_RETRY_BACKOFF_SECONDS, RETRY_STATUSES,
+)
+
+# All AsyncFrappeClient instances send their requests through one keep-alive
+# connection pool. Every instance still has its own cookie jar, so one user's
+# Frappe login never leaks into another user's client.
+#
+# Every request passes the circuit breaker in breaker.py. GETs that fail to
+# connect, time out or get a 502/503/504 are retried up to FRAPPE_GET_RETRIES
+# times with jittered backoff, as long as the shared retry budget allows it,
+# so retries can't multiply the load on a Frappe that is already struggling.
+
+FRAPPE_POOL_SIZE = config('FRAPPE_POOL_SIZE', cast=int, default=20)
+FRAPPE_POOL_KEEPALIVE = config('FRAPPE_POOL_KEEPALIVE', cast=int, default=10)
+FRAPPE_POOL_TIMEOUT = config('FRAPPE_POOL_TIMEOUT', cast=float, default=5.0)
+FRAPPE_URL = config('FRAPPE_URL')
+# service account for server-side calls (invoice PDFs, the invoice sync);
+# user Frappe sessions only live for the login request
+FRAPPE_API_KEY = config('FRAPPE_API_KEY', default="")
+FRAPPE_API_SECRET = config('FRAPPE_API_SECRET', default="")
+
+_pool = None
+
+
+class _SharedTransport(httpx.AsyncBaseTransport):
+	'''Hands requests to the shared pool; closing a client leaves the pool open'''
+	def __init__(self, transport):
+		self._transport = transport
+
+	async def handle_async_request(self, request):
+		frappe_retry_budget.request()
+		# calls expected to be slow (PDF rendering) set their own threshold
+		slow_seconds = request.extensions.get('frappe_slow_seconds')
+		attempt = 0
+		while True:
+			probe = frappe_breaker.before_call()
+			started = time.perf_counter()
+			try:
+				response = await self._transport.handle_async_request(request)
+			except httpx.PoolTimeout:
+				# our own pool is full, not a verdict on Frappe
+				frappe_breaker.cancelled(probe)
+				raise
+			except httpx.TransportError:
+				frappe_breaker.record(probe, False, time.perf_counter() - started, slow_seconds)
+				if not await self._retry(request, attempt):
+					raise
+				attempt += 1
+				continue
+			except BaseException:
+				frappe_breaker.cancelled(probe)
+				raise
+			frappe_breaker.record(probe, response.status_code < 500, time.perf_counter() - started, slow_seconds)
+			if response.status_code in RETRY_STATUSES and await self._retry(request, attempt):
+				await response.aclose()
+				attempt += 1
+				continue
+			return response
+
+	async def _retry(self, request, attempt):
+		if request.method not in ('GET', 'HEAD') or attempt >= FRAPPE_GET_RETRIES:
+			return False
+		if not frappe_retry_budget.try_retry():
+			FRAPPE_RETRIES.labels('budget_exhausted').inc()
+			return False
+		FRAPPE_RETRIES.labels('retried').inc()
+		await asyncio.sleep(random.uniform(0, FRAPPE_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+		return True
+
+	async def aclose(self):
+		pass
+
+
+def get_pool(verify=True):
+	global _pool
+	if _pool is None:
+		_pool = httpx.AsyncHTTPTransport(
+			verify=verify,
+			limits=httpx.Limits(
+				max_connections=FRAPPE_POOL_SIZE,
+				max_keepalive_connections=FRAPPE_POOL_KEEPALIVE,
+			),
+		)
+	return _pool
+
+
+async def close_pool():
+	global _pool
+	if _pool is not None:
+		await _pool.aclose()
+		_pool = None
+
+
+@instrument_frappe_calls(
+	'login', 'logout', 'get_list', 'insert', 'insert_many', 'update', 'bulk_update', 'delete',
+	'submit', 'get_value', 'set_value', 'cancel', 'get_doc', 'rename_doc', 'get_pdf', 'get_pdf_stream',
+	'get_html', 'get_upload_template',
+)
+class AsyncFrappeClient(object):
+	def __init__(self, url=None, api_key=None, api_secret=None, verify=True, timeout=FRAPPE_TIMEOUT,
+			connect_timeout=FRAPPE_CONNECT_TIMEOUT, read_timeout=FRAPPE_READ_TIMEOUT):
+		self.headers = dict(Accept='application/json')
+		self.session = httpx.AsyncClient(
+			transport=_SharedTransport(get_pool(verify)),
+			headers=self.headers,
+			timeout=httpx.Timeout(timeout, connect=connect_timeout, read=read_timeout, pool=FRAPPE_POOL_TIMEOUT),
+			trust_env=False,
+		)
+		self.can_download = []
+		self.url = url
+		self.logged_in = False
+
+		if api_key and api_secret:
+			self.authenticate(api_key, api_secret)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *args, **kwargs):
+		await self.aclose()
+
+	async def aclose(self):
+		if self.logged_in:
+			try:
+				await self.logout()
+			except httpx.HTTPError:
+				pass
+		await self.session.aclose()
+
+	async def login(self, username, password):
+		r = await self.session.post(self.url, data={
+			'cmd': 'login',
+			'usr': username,
+			'pwd': password
+		})
+
+		if r.json().get('message') == "Logged In":
+			self.can_download = []
+			self.logged_in = True
+			return r.json()
+		else:
+			raise AuthError
+
+	def authenticate(self, api_key, api_secret):
+		token = b64encode('{}:{}'.format(api_key, api_secret).encode()).decode()
+		auth_header = {'Authorization': 'Basic {}'.format(token)}
+		self.session.headers.update(auth_header)
+
+	async def logout(self):
+		await self.session.get(self.url, params={
+			'cmd': 'logout',
+		})
+		self.logged_in = False
+
+	async def get_list(self, doctype, fields=["*"], filters=None, limit_start=0, limit_page_length=0, order_by=None):
+		'''Returns list of records of a particular type'''
+		if not isinstance(fields, str):
+			fields = json.dumps(fields)
+		params = {
+			"fields": fields,
+		}
+		if filters:
+			params["filters"] = json.dumps(filters)
+		if limit_page_length:
+			params["limit_start"] = limit_start
+			params["limit_page_length"] = limit_page_length
+		if order_by:
+			params['order_by'] = order_by
+
+		res = await self.session.get(self.url + "/api/resource/" + doctype, params=params)
+		return self.post_process(res)
+
+	async def insert(self, doc):
+		'''Insert a document to the remote server
+
+		:param doc: A dict or Document object to be inserted remotely'''
+		res = await self.session.post(self.url + "/api/resource/" + quote(doc.get("doctype")),
+			data={"data": json.dumps(doc)})
+		return self.post_process(res)
+
+	async def insert_many(self, docs):
+		'''Insert multiple documents to the remote server
+
+		:param docs: List of dict or Document objects to be inserted in one request'''
+		return await self.post_request({
+			"cmd": "frappe.client.insert_many",
+			"docs": json.dumps(docs)
+		})
+
+	async def update(self, doc):
+		'''Update a remote document
+
+		:param doc: dict or Document object to be updated remotely. `name` is mandatory for this'''
+		url = self.url + "/api/resource/" + quote(doc.get("doctype")) + "/" + quote(doc.get("name"))
+		res = await self.session.put(url, data={"data": json.dumps(doc)})
+		return self.post_process(res)
+
+	async def bulk_update(self, docs):
+		'''Bulk update documents remotely
+
+		:param docs: List of dict or Document objects to be updated remotely (by `name`)'''
+		return await self.post_request({
+			'cmd': 'frappe.client.bulk_update',
+			'docs': json.dumps(docs)
+		})
+
+	async def delete(self, doctype, name):
+		'''Delete remote document by name
+
+		:param doctype: `doctype` to be deleted
+		:param name: `name` of document to be deleted'''
+		return await self.post_request({
+			'cmd': 'frappe.client.delete',
+			'doctype': doctype,
+			'name': name
+		})
+
+	async def submit(self, doclist):
+		'''Submit remote document
+
+		:param doc: dict or Document object to be submitted remotely'''
+		return await self.post_request({
+			'cmd': 'frappe.client.submit',
+			'doclist': json.dumps(doclist)
+		})
+
+	async def get_value(self, doctype, fieldname=None, filters=None):
+		return await self.get_request({
+			'cmd': 'frappe.client.get_value',
+			'doctype': doctype,
+			'fieldname': fieldname or 'name',
+			'filters': json.dumps(filters)
+		})
+
+	async def set_value(self, doctype, docname, fieldname, value):
+		return await self.post_request({
+			'cmd': 'frappe.client.set_value',
+			'doctype': doctype,
+			'name': docname,
+			'fieldname': fieldname,
+			'value': value
+		})
+
+	async def cancel(self, doctype, name):
+		return await self.post_request({
+			'cmd': 'frappe.client.cancel',
+			'doctype': doctype,
+			'name': name
+		})
+
+	async def get_doc(self, doctype, name="", filters=None, fields=None):
+		'''Returns a single remote document
+
+		:param doctype: DocType of the document to be returned
+		:param name: (optional) `name` of the document to be returned
+		:param filters: (optional) Filter by this dict if name is not set
+		:param fields: (optional) Fields to be returned, will return everythign if not set'''
+		params = {}
+		if filters:
+			params["filters"] = json.dumps(filters)
+		if fields:
+			params["fields"] = json.dumps(fields)
+
+		res = await self.session.get(self.url + '/api/resource/' + doctype + '/' + name,
+			params=params)
+
+		return self.post_process(res)
+
+	async def rename_doc(self, doctype, old_name, new_name):
+		'''Rename remote document
+
+		:param doctype: DocType of the document to be renamed
+		:param old_name: Current `name` of the document to be renamed
+		:param new_name: New `name` to be set'''
+		params = {
+			'cmd': 'frappe.client.rename_doc',
+			'doctype': doctype,
+			'old_name': old_name,
+			'new_name': new_name
+		}
+		return await self.post_request(params)
+
+	async def get_pdf(self, doctype, name, print_format='Standard', letterhead=True):
+		params = {
+			'doctype': doctype,
+			'name': name,
+			'format': print_format,
+			'no_letterhead': int(not bool(letterhead))
+		}
+		request = self.session.build_request('GET',
+			self.url + '/api/method/frappe.templates.pages.print.download_pdf',
+			params=params)
+		response = await self.session.send(request, stream=True)
+		return await self.post_process_file_stream(response)
+
+	async def get_pdf_stream(self, doctype, name, print_format='Standard', letterhead=True, read_timeout=None):
+		'''Like get_pdf, but returns the open response for the caller to read with
+		aiter_bytes() and then aclose(), so the PDF is never held in memory.
+		Rendering can take a while: `read_timeout` overrides the client's.'''
+		params = {
+			'doctype': doctype,
+			'name': name,
+			'format': print_format,
+			'no_letterhead': int(not bool(letterhead))
+		}
+		timeout = self.session.timeout
+		if read_timeout is not None:
+			timeout = httpx.Timeout(**{**timeout.as_dict(), 'read': read_timeout})
+		request = self.session.build_request('GET',
+			self.url + '/api/method/frappe.templates.pages.print.download_pdf',
+			params=params, timeout=timeout,
+			extensions={'frappe_slow_seconds': timeout.read})
+		response = await self.session.send(request, stream=True)
+		if response.is_success:
+			return response
+		try:
+			await response.aread()
+		finally:
+			await response.aclose()
+		try:
+			self.post_process(response)  # raises with Frappe's own message when there is one
+		except ValueError:
+			pass
+		raise FrappeException('PDF download failed with HTTP {}'.format(response.status_code))
+
+	async def get_html(self, doctype, name, print_format='Standard', letterhead=True):
+		params = {
+			'doctype': doctype,
+			'name': name,
+			'format': print_format,
+			'no_letterhead': int(not bool(letterhead))
+		}
+		request = self.session.build_request('GET', self.url + '/print', params=params)
+		response = await self.session.send(request, stream=True)
+		return await self.post_process_file_stream(response)
+
+	async def __load_downloadable_templates(self):
+		self.can_download = await self.get_api('frappe.core.page.data_import_tool.data_import_tool.get_doctypes')
+
+	async def get_upload_template(self, doctype, with_data=False):
+		if not self.can_download:
+			await self.__load_downloadable_templates()
+
+		if doctype not in self.can_download:
+			raise NotUploadableException(doctype)
+
+		params = {
+			'doctype': doctype,
+			'parent_doctype': doctype,
+			'with_data': 'Yes' if with_data else 'No',
+			'all_doctypes': 'Yes'
+		}
+
+		request = self.session.build_request('GET',
+			self.url + '/api/method/frappe.core.page.data_import_tool.exporter.get_template',
+			params=params)
+		response = await self.session.send(request, stream=True)
+		return await self.post_process_file_stream(response)
+
+	async def get_api(self, method, params={}):
+		res = await self.session.get(self.url + '/api/method/' + method + '/', params=params)
+		return self.post_process(res)
+
+	async def post_api(self, method, params={}):
+		res = await self.session.post(self.url + '/api/method/' + method + '/', params=params)
+		return self.post_process(res)
+
+	async def get_request(self, params):
+		res = await self.session.get(self.url, params=self.preprocess(params))
+		return self.post_process(res)
+
+	async def post_request(self, data):
+		res = await self.session.post(self.url, data=self.preprocess(data))
+		return self.post_process(res)
+
+	def preprocess(self, params):
+		'''convert dicts, lists to json'''
+		for key, value in params.items():
+			if isinstance(value, (dict, list)):
+				params[key] = json.dumps(value)
+
+		return params
+
+	def post_process(self, response):
+		try:
+			rjson = response.json()
+		except ValueError:
+			print(response.text)
+			raise
+
+		if rjson and ('exc' in rjson) and rjson['exc']:
+			raise FrappeException(rjson['exc'])
+		if 'message' in rjson:
+			return rjson['message']
+		elif 'data' in rjson:
+			return rjson['data']
+		else:
+			return None
+
+	async def post_process_file_stream(self, response):
+		try:
+			if response.is_success:
+				output = BytesIO()
+				async for block in response.aiter_bytes(64 * 1024):
+					output.write(block)
+				output.seek(0)
+				return output
+
+			await response.aread()
+		finally:
+			await response.aclose()
+		return self.post_process(response)
+
+
+def service_client(**kwargs):
+	'''AsyncFrappeClient authenticated with the service account's API key'''
+	return AsyncFrappeClient(FRAPPE_URL, FRAPPE_API_KEY, FRAPPE_API_SECRET, **kwargs)
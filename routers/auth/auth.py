@@ -1,18 +1,25 @@
 import os
-from fastapi import FastAPI, APIRouter, Body, HTTPException, status,Response, Cookie,Depends,BackgroundTasks
+import asyncio
+from fastapi import FastAPI, APIRouter, Body, HTTPException, status,Response, Cookie,Depends,BackgroundTasks,Security,Query,Request
+from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse,FileResponse
+from fastapi.responses import JSONResponse,FileResponse,StreamingResponse
 from pydantic import BaseModel
-from .frappeclient import FrappeClient
+from .frappeclient import AuthError, FrappeException
+from .async_frappeclient import AsyncFrappeClient
+from .breaker import CircuitOpen
 from jose import JWTError,jwt
 from datetime import datetime, timedelta, timezone
-import requests
+import httpx
 from decouple import config
 from typing import Optional,Union,List
-from routers.utils import create_backup
+from routers.utils import get_current_user, check_roles, optional_security, AUTH_MODE, SESSION_LIFETIME_MINUTES, TOKEN_EXPIRE_MINUTES
+from routers.session_cache import session_cache
+from routers.revocation import revocation_list
+from routers.backup import run_backup, backup_lock, public_progress, backup_catalog, BACKUP_DIR
 import uuid
 
-from database import invoicedb as db
+from database import invoicedb as db, index_report
 
 session_collection = db.get_collection("sessions")
 
@@ -24,7 +31,6 @@ FRAPPE_URL = config('FRAPPE_URL')
 
 
 router = APIRouter()
-client = FrappeClient(FRAPPE_URL)
 
 class LoginData(BaseModel):
     username: str
@@ -34,34 +40,60 @@ class LoginData(BaseModel):
 @router.post("/", response_description="Auth")
 async def auth(response: Response, form_data: OAuth2PasswordRequestForm = Depends()):
     try:
-        await client.login(form_data.username, form_data.password)
-
-    except requests.exceptions.HTTPError as http_err:
-        if http_err.response.status_code == 401:
-           raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Incorrect username or password",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        else:
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={"message": {
-                    "success_key": 0,
-                    "message": f"HTTP error occurred: {http_err}"
-                }}
-            )
-
-    except requests.exceptions.ConnectionError:
+        # the Frappe session only lives for this request, the client logs out on exit
+        async with AsyncFrappeClient(FRAPPE_URL) as frappe:
+            await frappe.login(form_data.username, form_data.password)
+            user = await frappe.get_doc('User', form_data.username)
+
+    except AuthError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    except (httpx.HTTPStatusError, FrappeException) as http_err:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"message": {
+                "success_key": 0,
+                "message": f"HTTP error occurred: {http_err}"
+            }}
+        )
+
+    except httpx.TransportError as exc:
+        # also raised without calling Frappe while the circuit breaker is open
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             content={"message": {
                 "success_key": 0,
                 "message": "Unable to connect to Frappe server. Please try again later."
-            }}
+            }},
+            headers={"Retry-After": str(int(exc.retry_after) + 1)} if isinstance(exc, CircuitOpen) else None,
         )
 
-    user = client.get_doc('User', form_data.username)
+    roles = [r.get("role") for r in user.get("roles")]
+
+    if AUTH_MODE == "token":
+        # stateless mode: nothing is stored, the signed token is the session
+        expires_delta = timedelta(minutes=TOKEN_EXPIRE_MINUTES)
+        access_token = create_access_token({
+            "sub": user.get("username"),
+            "email": user.get("email"),
+            "roles": roles,
+            "jti": str(uuid.uuid4()),
+        }, expires_delta)
+        response.set_cookie(
+            key="access_token",
+            value=access_token,
+            httponly=True,
+            max_age=TOKEN_EXPIRE_MINUTES * 60,
+            expires=TOKEN_EXPIRE_MINUTES * 60,
+            secure=False,  # Use this in production with HTTPS
+            samesite="lax",
+            path="/",
+        )
+        return {"message": "Login successful", "access_token": access_token, "token_type": "bearer"}
 
     # Create a session for the user
     session_id = str(uuid.uuid4())
@@ -70,9 +102,9 @@ async def auth(response: Response, form_data: OAuth2PasswordRequestForm = Depend
         "session_id": session_id,
         "username": user.get("username"),
         "email": user.get("email"),
-        "roles": [r.get("role") for r in user.get("roles")],
+        "roles": roles,
         "created_at": datetime.now(timezone.utc),
-        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=30)  # 30 minutes expiration
+        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=SESSION_LIFETIME_MINUTES)
     }
     
     await session_collection.insert_one(session_data)
@@ -82,8 +114,8 @@ async def auth(response: Response, form_data: OAuth2PasswordRequestForm = Depend
         key="session_id",
         value=session_id,
         httponly=False,
-        max_age=1800,  # 30 minutes
-        expires=1800,
+        max_age=SESSION_LIFETIME_MINUTES * 60,
+        expires=SESSION_LIFETIME_MINUTES * 60,
         secure=False,  # Use this in production with HTTPS
         samesite="lax",
         # domain=".example.com",  # Ensure this is set correctly
@@ -96,15 +128,42 @@ async def auth(response: Response, form_data: OAuth2PasswordRequestForm = Depend
 
 
 @router.post("/logout", response_description="logout")
-async def logout(response: Response, session_id: str = Cookie(None)):
+async def logout(
+    response: Response,
+    session_id: str = Cookie(None),
+    access_token: str = Cookie(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Security(optional_security),
+):
     if session_id:
+        session_cache.invalidate(session_id)
         await session_collection.delete_one({"session_id": session_id})
+    token = credentials.credentials if credentials else access_token
+    if token:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            payload = {}  # expired or invalid, nothing left to revoke
+        if payload.get("jti"):
+            await revocation_list.revoke(payload["jti"], datetime.fromtimestamp(payload["exp"], timezone.utc))
     response.delete_cookie("session_id")
-    client.logout()
+    response.delete_cookie("access_token")
     return {"message": "Logout successful"}
 
 
 
+@router.get("/session_cache", response_description="Session cache counters")
+async def session_cache_stats():
+    return session_cache.stats()
+
+
+
+@router.get("/indexes", response_description="Missing and unused indexes")
+@check_roles(["admin"])
+async def indexes(current_user: dict = Depends(get_current_user)):
+    return await index_report()
+
+
+
 # create jwt auth
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -118,37 +177,95 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 @router.post("/backup")
-async def backup_database(background_tasks: BackgroundTasks):
-    background_tasks.add_task(create_backup)
-    return {"message": "Backup process started"}
+async def backup_database(background_tasks: BackgroundTasks, mode: str = Query("full", pattern="^(full|incremental)$")):
+    if backup_lock.locked():
+        raise HTTPException(status_code=409, detail="A backup is already running")
+    background_tasks.add_task(run_backup, mode)
+    return {"message": "Backup process started", "mode": mode, "progress": "/api/auth/backup/status"}
+
+
+@router.get("/backup/status")
+async def backup_status():
+    # documents, bytes and throughput of the running (or last) backup
+    return public_progress()
 
 
 @router.get("/backups", response_model=List[str])
 async def list_backups():
-    current_file_path = os.path.abspath(__file__)
-    current_directory = current_file_path
-    while os.path.basename(current_directory) != 'fast-api-backend':
-        current_directory = os.path.dirname(current_directory)
+    return [entry["file"] for entry in backup_catalog.entries()]  # Most recent first
+
+
+@router.get("/backups/catalog")
+async def backup_catalog_entries():
+    return backup_catalog.entries()
+
+
+def parse_byte_range(range_header: str, size: int):
+    '''(start, end) inclusive for a single "bytes=" range, None when the header can't be used'''
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None  # multiple ranges: answer with the whole file
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            length = int(end)  # suffix range, the last N bytes
+            if length <= 0:
+                raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            return max(size - length, 0), size - 1
+        start, end = int(start), int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    if end < start:
+        return None  # syntactically invalid, RFC 9110 says ignore the header
+    return start, min(end, size - 1)
+
+
+async def read_file_range(path: str, start: int, end: int, chunk_size: int = 1024 * 1024):
+    with open(path, "rb") as f:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
 
-    backup_dir = os.path.join(current_directory, 'backups')
-    
-    if not os.path.exists(backup_dir):
-        return []
-    
-    backups = [f for f in os.listdir(backup_dir) if f.endswith('.gz')]
-    return sorted(backups, reverse=True)  # Most recent first
 
 @router.get("/backups/{filename}")
-async def download_backup(filename: str):
-    current_file_path = os.path.abspath(__file__)
-    current_directory = current_file_path
-    while os.path.basename(current_directory) != 'fast-api-backend':
-        current_directory = os.path.dirname(current_directory)
-
-    backup_dir = os.path.join(current_directory, 'backups')
-    file_path = os.path.join(backup_dir, filename)
-    
-    if not os.path.exists(file_path):
+async def download_backup(filename: str, request: Request):
+    # only files recorded in the catalog can be downloaded
+    entry = backup_catalog.get(filename)
+    file_path = os.path.join(BACKUP_DIR, filename)
+    if entry is None or not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Backup file not found")
-    
-    return FileResponse(file_path, media_type='application/gzip', filename=filename)
+
+    size = entry["size"]
+    etag = f'"{entry["sha256"]}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "X-Checksum-SHA256": entry["sha256"],
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # a resumed download only gets the tail if the archive is still the one it started with
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_byte_range(range_header, size)
+
+    if byte_range is None:
+        return FileResponse(file_path, media_type='application/gzip', filename=filename, headers=headers)
+
+    start, end = byte_range
+    headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+    return StreamingResponse(
+        read_file_range(file_path, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type='application/gzip',
+        headers=headers,
+    )
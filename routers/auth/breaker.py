@@ -0,0 +1,191 @@
+import time
+from collections import Counter, deque
+from decouple import config
+import httpx
+
+from metrics import FRAPPE_BREAKER_STATE, FRAPPE_BREAKER_TRANSITIONS, FRAPPE_BREAKER_REJECTED
+
+# Circuit breaker and retry budget for the requests AsyncFrappeClient sends
+# (applied in its shared transport, see async_frappeclient.py).
+#
+# The breaker watches the last FRAPPE_BREAKER_WINDOW_SECONDS of calls. Once at
+# least FRAPPE_BREAKER_MIN_CALLS were made and either the share of failures
+# (connection errors, timeouts, 5xx) reaches FRAPPE_BREAKER_ERROR_RATE or the
+# share of calls slower than FRAPPE_BREAKER_SLOW_SECONDS reaches
+# FRAPPE_BREAKER_SLOW_RATE, it opens: for FRAPPE_BREAKER_OPEN_SECONDS every call
+# fails at once with CircuitOpen instead of tying up a worker. After that up to
+# FRAPPE_BREAKER_PROBES calls are let through (half open); if they all succeed
+# the breaker closes, otherwise it opens again.
+#
+# CircuitOpen is an httpx.TransportError, so callers already handling Frappe
+# being unreachable (the 503 in auth, the sync's backoff) handle it as well.
+# State is per worker.
+
+FRAPPE_BREAKER_WINDOW_SECONDS = config('FRAPPE_BREAKER_WINDOW_SECONDS', cast=int, default=10)
+FRAPPE_BREAKER_MIN_CALLS = config('FRAPPE_BREAKER_MIN_CALLS', cast=int, default=20)
+FRAPPE_BREAKER_ERROR_RATE = config('FRAPPE_BREAKER_ERROR_RATE', cast=float, default=0.5)
+FRAPPE_BREAKER_SLOW_SECONDS = config('FRAPPE_BREAKER_SLOW_SECONDS', cast=float, default=2.0)
+FRAPPE_BREAKER_SLOW_RATE = config('FRAPPE_BREAKER_SLOW_RATE', cast=float, default=0.5)
+FRAPPE_BREAKER_OPEN_SECONDS = config('FRAPPE_BREAKER_OPEN_SECONDS', cast=float, default=30)
+FRAPPE_BREAKER_PROBES = config('FRAPPE_BREAKER_PROBES', cast=int, default=3)
+# retries may add FRAPPE_RETRY_RATIO of the request rate, plus a trickle for quiet periods
+FRAPPE_RETRY_RATIO = config('FRAPPE_RETRY_RATIO', cast=float, default=0.1)
+FRAPPE_RETRY_MIN_PER_SECOND = config('FRAPPE_RETRY_MIN_PER_SECOND', cast=float, default=1)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(httpx.TransportError):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Frappe circuit breaker is open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RollingCounts:
+    '''Per-second counters covering the last `seconds` seconds'''
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self._buckets = deque()  # (second, Counter)
+
+    def _prune(self, now: int):
+        while self._buckets and self._buckets[0][0] <= now - self.seconds:
+            self._buckets.popleft()
+
+    def add(self, **counts):
+        now = int(time.monotonic())
+        self._prune(now)
+        if not self._buckets or self._buckets[-1][0] != now:
+            self._buckets.append((now, Counter()))
+        self._buckets[-1][1].update(counts)
+
+    def totals(self) -> Counter:
+        self._prune(int(time.monotonic()))
+        totals = Counter()
+        for _, counts in self._buckets:
+            totals.update(counts)
+        return totals
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: int = FRAPPE_BREAKER_WINDOW_SECONDS,
+        min_calls: int = FRAPPE_BREAKER_MIN_CALLS,
+        error_rate: float = FRAPPE_BREAKER_ERROR_RATE,
+        slow_seconds: float = FRAPPE_BREAKER_SLOW_SECONDS,
+        slow_rate: float = FRAPPE_BREAKER_SLOW_RATE,
+        open_seconds: float = FRAPPE_BREAKER_OPEN_SECONDS,
+        probes: int = FRAPPE_BREAKER_PROBES,
+    ):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.state = CLOSED
+        self.reason = None
+        self._calls = RollingCounts(window)
+        self._opened_at = None
+        self._probes_running = 0
+        self._probes_passed = 0
+        FRAPPE_BREAKER_STATE.set(STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str, reason: str = None):
+        self.state = state
+        self.reason = reason
+        FRAPPE_BREAKER_STATE.set(STATE_VALUES[state])
+        FRAPPE_BREAKER_TRANSITIONS.labels(state).inc()
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            print(f"Frappe circuit breaker opened: {reason}")
+        elif state == HALF_OPEN:
+            self._probes_running = self._probes_passed = 0
+        else:
+            self._calls.clear()
+            print("Frappe circuit breaker closed")
+
+    def before_call(self) -> bool:
+        '''Raises CircuitOpen, or returns whether this call is a half-open probe'''
+        if self.state == OPEN:
+            retry_after = self._opened_at + self.open_seconds - time.monotonic()
+            if retry_after > 0:
+                FRAPPE_BREAKER_REJECTED.inc()
+                raise CircuitOpen(retry_after)
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probes_running >= self.probes:
+                FRAPPE_BREAKER_REJECTED.inc()
+                raise CircuitOpen(1)
+            self._probes_running += 1
+            return True
+        return False
+
+    def record(self, probe: bool, ok: bool, elapsed: float, slow_seconds: float = None):
+        slow = elapsed >= (slow_seconds or self.slow_seconds)
+        if probe:
+            self._probes_running -= 1
+            if self.state != HALF_OPEN:
+                return
+            if not ok or slow:
+                self._transition(OPEN, "probe " + ("failed" if not ok else f"took {elapsed:.1f}s"))
+                return
+            self._probes_passed += 1
+            if self._probes_passed >= self.probes:
+                self._transition(CLOSED)
+            return
+        if self.state != CLOSED:
+            return  # started before the breaker opened
+        self._calls.add(calls=1, failures=int(not ok), slow=int(slow))
+        totals = self._calls.totals()
+        if totals["calls"] < self.min_calls:
+            return
+        if totals["failures"] / totals["calls"] >= self.error_rate:
+            self._transition(OPEN, f"{totals['failures']} of {totals['calls']} calls failed")
+        elif totals["slow"] / totals["calls"] >= self.slow_rate:
+            self._transition(OPEN, f"{totals['slow']} of {totals['calls']} calls took over {self.slow_seconds}s")
+
+    def cancelled(self, probe: bool):
+        # the caller went away, which says nothing about Frappe
+        if probe:
+            self._probes_running -= 1
+
+    def snapshot(self) -> dict:
+        totals = self._calls.totals()
+        calls = totals["calls"]
+        snapshot = {
+            "state": self.state,
+            "reason": self.reason,
+            "calls": calls,
+            "failure_rate": totals["failures"] / calls if calls else 0.0,
+            "slow_rate": totals["slow"] / calls if calls else 0.0,
+        }
+        if self.state == OPEN:
+            snapshot["retry_after"] = max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+        return snapshot
+
+
+class RetryBudget:
+    '''Over any window, retries stay under ratio * requests + min_per_second * window'''
+    def __init__(self, ratio: float = FRAPPE_RETRY_RATIO, min_per_second: float = FRAPPE_RETRY_MIN_PER_SECOND, window: int = FRAPPE_BREAKER_WINDOW_SECONDS):
+        self.ratio = ratio
+        self.reserve = min_per_second * window
+        self._counts = RollingCounts(window)
+
+    def request(self):
+        self._counts.add(requests=1)
+
+    def try_retry(self) -> bool:
+        totals = self._counts.totals()
+        if totals["retries"] + 1 > self.ratio * totals["requests"] + self.reserve:
+            return False
+        self._counts.add(retries=1)
+        return True
+
+
+frappe_breaker = CircuitBreaker()
+frappe_retry_budget = RetryBudget()
@@ -1,14 +1,23 @@
 import requests
 import json
 from base64 import b64encode
-from io import StringIO
+from io import BytesIO
 
 from urllib.parse import quote
 
-try:
-	from StringIO import StringIO
-except:
-	from io import StringIO
+from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Seconds. Connecting to a healthy Frappe is quick, so that phase gets a short
+# limit; FRAPPE_READ_TIMEOUT is the longest wait for a response byte.
+FRAPPE_TIMEOUT = config('FRAPPE_TIMEOUT', cast=float, default=10.0)
+FRAPPE_CONNECT_TIMEOUT = config('FRAPPE_CONNECT_TIMEOUT', cast=float, default=3.0)
+FRAPPE_READ_TIMEOUT = config('FRAPPE_READ_TIMEOUT', cast=float, default=FRAPPE_TIMEOUT)
+# extra attempts for idempotent GETs that failed to connect, timed out or got a 502/503/504
+FRAPPE_GET_RETRIES = config('FRAPPE_GET_RETRIES', cast=int, default=2)
+FRAPPE_RETRY_BACKOFF_SECONDS = config('FRAPPE_RETRY_BACKOFF_SECONDS', cast=float, default=0.1)
+RETRY_STATUSES = (502, 503, 504)
 
 try:
     unicode
@@ -29,10 +38,33 @@ class NotUploadableException(FrappeException):
 		self.message = "The doctype `{1}` is not uploadable, so you can't download the template".format(doctype)
 
 
+class _TimeoutAdapter(HTTPAdapter):
+	'''Applies the client's timeouts to requests that don't pass their own'''
+	def __init__(self, timeout, **kwargs):
+		self.timeout = timeout
+		super().__init__(**kwargs)
+
+	def send(self, request, **kwargs):
+		if kwargs.get('timeout') is None:
+			kwargs['timeout'] = self.timeout
+		return super().send(request, **kwargs)
+
+
 class FrappeClient(object):
-	def __init__(self, url=None, username=None, password=None, api_key=None, api_secret=None, verify=True):
+	def __init__(self, url=None, username=None, password=None, api_key=None, api_secret=None, verify=True,
+			timeout=(FRAPPE_CONNECT_TIMEOUT, FRAPPE_READ_TIMEOUT)):
 		self.headers = dict(Accept='application/json')
 		self.session = requests.Session()
+		adapter = _TimeoutAdapter(timeout, max_retries=Retry(
+			total=FRAPPE_GET_RETRIES,
+			allowed_methods=frozenset(['GET', 'HEAD']),
+			status_forcelist=RETRY_STATUSES,
+			backoff_factor=FRAPPE_RETRY_BACKOFF_SECONDS,
+			backoff_jitter=FRAPPE_RETRY_BACKOFF_SECONDS,
+			raise_on_status=False,
+		))
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
 		self.can_download = []
 		self.verify = verify
 		self.url = url
@@ -105,7 +137,7 @@ class FrappeClient(object):
 		:param docs: List of dict or Document objects to be inserted in one request'''
 		return self.post_request({
 			"cmd": "frappe.client.insert_many",
-			"docs": frappe.as_json(docs)
+			"docs": json.dumps(docs)
 		})
 
 	def update(self, doc):
@@ -293,9 +325,11 @@ class FrappeClient(object):
 
 	def post_process_file_stream(self, response):
 		if response.ok:
-			output = StringIO()
-			for block in response.iter_content(1024):
+			# PDFs and templates are binary, and 64 KB reads keep the loop count down
+			output = BytesIO()
+			for block in response.iter_content(64 * 1024):
 				output.write(block)
+			output.seek(0)
 			return output
 
 		else:
@@ -0,0 +1,392 @@
+import asyncio
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from bson import encode, decode_file_iter
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from decouple import config
+from fastapi import HTTPException
+from pymongo import ReplaceOne
+
+from database import invoicedb as db
+
+# In-process backups, streamed from Motor cursors into a gzip archive.
+#
+# An archive is a gzip stream of BSON records:
+#   {"c": <collection>, "d": <document>}   a document to restore
+#   {"c": <collection>, "live": [_id...]}  incremental only, ids that still exist
+# and <name>.json next to it is the manifest a restore follows.
+#
+# A full backup copies every collection. An incremental backup copies the
+# documents of INCREMENTAL_FIELDS collections whose watermark field moved since
+# the previous backup, plus their live ids so deletes can be replayed, and
+# copies the remaining (small) collections whole. Indexes are not archived,
+# ensure_indexes() rebuilds them when the app starts.
+
+BACKUP_DIR = config('BACKUP_DIR', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backups'))
+BACKUP_FLUSH_BYTES = config('BACKUP_FLUSH_BYTES', cast=int, default=4 * 1024 * 1024)
+INCREMENTAL_FIELDS = {"invoices": "updated_at"}
+LIVE_IDS_PER_RECORD = 10000
+
+RAW_CODEC = CodecOptions(document_class=RawBSONDocument)
+
+backup_lock = asyncio.Lock()
+backup_progress = {"running": False}
+
+
+def backup_timestamp() -> str:
+    utc_time = datetime.now(timezone.utc)
+    ist_time = utc_time + timedelta(hours=5, minutes=30)
+    return ist_time.strftime("%d-%m-%Y_%H-%M-%S")
+
+
+def read_manifest(name: str) -> dict:
+    with open(os.path.join(BACKUP_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def latest_manifest():
+    manifests = []
+    for path in glob.glob(os.path.join(BACKUP_DIR, "*.json")):
+        with open(path) as f:
+            manifest = json.load(f)
+        if "name" in manifest and manifest.get("finished_at"):
+            manifests.append(manifest)
+    return max(manifests, key=lambda manifest: manifest["started_at"], default=None)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BackupCatalog:
+    '''Size, checksum and creation time of every archive, recorded when it is written.
+
+    Kept in BACKUP_DIR/catalog.json and cached in memory, so listing and
+    downloading backups never scans the directory. The cache is reloaded when
+    catalog.json changes on disk (another worker recorded a backup), and
+    writers hold an flock on catalog.lock so concurrent records don't drop
+    each other's entries.'''
+    def __init__(self):
+        self._entries = None
+        self._mtime = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(BACKUP_DIR, "catalog.json")
+
+    def _scan(self) -> dict:
+        # one-off import of archives written before the catalog existed
+        entries = {}
+        for path in glob.glob(os.path.join(BACKUP_DIR, "*.gz")):
+            file = os.path.basename(path)
+            manifest_path = path[:-len(".gz")] + ".json"
+            manifest = {}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            entries[file] = {
+                "file": file,
+                "size": os.path.getsize(path),
+                "sha256": file_sha256(path),
+                "created_at": manifest.get("finished_at")
+                    or datetime.utcfromtimestamp(os.path.getmtime(path)).isoformat(),
+                "type": manifest.get("type", "full"),
+                "parent": manifest.get("parent"),
+            }
+        return entries
+
+    def _disk_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read(self) -> dict:
+        mtime = self._disk_mtime()
+        if self._entries is not None and mtime == self._mtime:
+            return self._entries
+        if mtime is not None:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+            self._mtime = mtime
+        elif self._entries is None:
+            self._entries = self._scan() if os.path.isdir(BACKUP_DIR) else {}
+            if self._entries:
+                self._save()
+        return self._entries
+
+    def load(self) -> dict:
+        if self._entries is None and self._disk_mtime() is None:
+            with self._locked():  # only one worker imports the existing archives
+                return self._read()
+        return self._read()
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        with open(os.path.join(BACKUP_DIR, "catalog.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._mtime = self._disk_mtime()
+
+    def add(self, entry: dict):
+        with self._locked():
+            # re-read under the lock, the copy in memory may predate another worker's write
+            self._read()[entry["file"]] = entry
+            self._save()
+
+    def get(self, file: str):
+        return self.load().get(file)
+
+    def entries(self) -> list:
+        # most recent first
+        return sorted(self.load().values(), key=lambda entry: entry["created_at"], reverse=True)
+
+    def reset(self):
+        self._entries = None
+        self._mtime = None
+
+
+backup_catalog = BackupCatalog()
+
+
+class ArchiveWriter:
+    '''Buffers encoded records and writes them compressed off the event loop'''
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.pending = []
+        self.pending_bytes = 0
+        self.raw_bytes = 0
+        self.written_bytes = 0
+        self.sha256 = hashlib.sha256()
+
+    async def write(self, record: dict):
+        data = encode(record)
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        self.raw_bytes += len(data)
+        if self.pending_bytes >= BACKUP_FLUSH_BYTES:
+            await self.flush()
+
+    def _compress_and_write(self, data: bytes, final: bool):
+        chunk = self.compressor.compress(data)
+        if final:
+            chunk += self.compressor.flush()
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        return len(chunk)
+
+    async def flush(self, final: bool = False):
+        data = b"".join(self.pending)
+        self.pending, self.pending_bytes = [], 0
+        self.written_bytes += await asyncio.to_thread(self._compress_and_write, data, final)
+
+    async def close(self):
+        await self.flush(final=True)
+        await asyncio.to_thread(self.file.close)
+
+
+def update_progress(writer: ArchiveWriter, **fields):
+    backup_progress.update(fields)
+    elapsed = time.monotonic() - backup_progress["_started"]
+    backup_progress.update(
+        elapsed=round(elapsed, 2),
+        bytes_raw=writer.raw_bytes,
+        bytes_written=writer.written_bytes,
+        docs_per_sec=round(backup_progress["documents"] / elapsed, 1) if elapsed else 0.0,
+        mb_per_sec=round(writer.raw_bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+    )
+
+
+async def copy_documents(writer: ArchiveWriter, collection_name: str, query: dict) -> int:
+    # raw documents go into the archive without being decoded to dicts
+    collection = db.get_collection(collection_name, codec_options=RAW_CODEC)
+    count = 0
+    async for doc in collection.find(query):
+        await writer.write({"c": collection_name, "d": doc})
+        count += 1
+        backup_progress["documents"] += 1
+        if count % 1000 == 0:
+            update_progress(writer)
+    return count
+
+
+async def copy_live_ids(writer: ArchiveWriter, collection_name: str):
+    ids = []
+    async for doc in db[collection_name].find({}, {"_id": 1}):
+        ids.append(doc["_id"])
+        if len(ids) >= LIVE_IDS_PER_RECORD:
+            await writer.write({"c": collection_name, "live": ids})
+            ids = []
+    await writer.write({"c": collection_name, "live": ids})
+
+
+async def run_backup(mode: str = "full") -> dict:
+    if backup_lock.locked():
+        raise HTTPException(status_code=409, detail="A backup is already running")
+    async with backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        parent = latest_manifest() if mode == "incremental" else None
+        if parent is None:
+            mode = "full"  # nothing to increment from yet
+
+        name = f"{db.name}_{backup_timestamp()}" + ("_inc" if mode == "incremental" else "")
+        started_at = datetime.utcnow()
+        manifest = {
+            "name": name,
+            "file": f"{name}.gz",
+            "type": mode,
+            "base": (parent.get("base") or parent["name"]) if parent else None,
+            "parent": parent["name"] if parent else None,
+            # changes at or after this instant belong to the next increment
+            "watermark": started_at.isoformat(),
+            "since": parent["watermark"] if parent else None,
+            "started_at": started_at.isoformat(),
+            "collections": {},
+        }
+        backup_progress.clear()
+        backup_progress.update(running=True, name=name, type=mode, collection=None,
+                               documents=0, error=None, _started=time.monotonic())
+
+        path = os.path.join(BACKUP_DIR, manifest["file"])
+        writer = ArchiveWriter(path)
+        try:
+            collection_names = sorted(
+                collection for collection in await db.list_collection_names() if not collection.startswith("system.")
+            )
+            for collection_name in collection_names:
+                update_progress(writer, collection=collection_name)
+                field = INCREMENTAL_FIELDS.get(collection_name)
+                if mode == "incremental" and field:
+                    since = datetime.fromisoformat(manifest["since"])
+                    count = await copy_documents(writer, collection_name, {field: {"$gte": since}})
+                    await copy_live_ids(writer, collection_name)
+                    manifest["collections"][collection_name] = {"mode": "changes", "field": field, "documents": count}
+                else:
+                    count = await copy_documents(writer, collection_name, {})
+                    manifest["collections"][collection_name] = {"mode": "replace", "documents": count}
+            await writer.close()
+        except Exception as exc:
+            writer.file.close()
+            os.remove(path)
+            backup_progress.update(running=False, error=str(exc))
+            print(f"Backup failed: {exc}")
+            raise HTTPException(status_code=500, detail=f"Backup failed: {exc}")
+
+        update_progress(writer, collection=None, running=False)
+        manifest.update(
+            finished_at=datetime.utcnow().isoformat(),
+            documents=backup_progress["documents"],
+            bytes_raw=writer.raw_bytes,
+            bytes=writer.written_bytes,
+            docs_per_sec=backup_progress["docs_per_sec"],
+            mb_per_sec=backup_progress["mb_per_sec"],
+        )
+        # the manifest is written last, so a backup without one never counts as complete
+        with open(os.path.join(BACKUP_DIR, f"{name}.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        backup_catalog.add({
+            "file": manifest["file"],
+            "size": writer.written_bytes,
+            "sha256": writer.sha256.hexdigest(),
+            "created_at": manifest["finished_at"],
+            "type": mode,
+            "parent": manifest["parent"],
+        })
+        print(f"Backup created successfully: {manifest['file']}")
+        return {"status": "success", "file": manifest["file"], "manifest": manifest}
+
+
+def public_progress() -> dict:
+    return {key: value for key, value in backup_progress.items() if not key.startswith("_")}
+
+
+def restore_chain(name: str) -> list:
+    chain = [read_manifest(name)]
+    while chain[0]["parent"]:
+        chain.insert(0, read_manifest(chain[0]["parent"]))
+    return chain
+
+
+async def _write_batch(collection_name: str, mode: str, docs: list):
+    if not docs:
+        return
+    if mode == "replace":
+        await db[collection_name].insert_many(docs, ordered=False)
+    else:
+        await db[collection_name].bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False
+        )
+
+
+async def apply_archive(manifest: dict):
+    modes = {name: info["mode"] for name, info in manifest["collections"].items()}
+    for collection_name, mode in modes.items():
+        if mode == "replace":
+            await db[collection_name].drop()
+
+    live = {}
+    pending = {}
+    with gzip.open(os.path.join(BACKUP_DIR, manifest["file"]), "rb") as f:
+        for record in decode_file_iter(f, codec_options=RAW_CODEC):
+            collection_name = record["c"]
+            if "live" in record:
+                live.setdefault(collection_name, set()).update(record["live"])
+                continue
+            batch = pending.setdefault(collection_name, [])
+            batch.append(record["d"])
+            if len(batch) >= 1000:
+                await _write_batch(collection_name, modes[collection_name], batch)
+                pending[collection_name] = []
+    for collection_name, batch in pending.items():
+        await _write_batch(collection_name, modes[collection_name], batch)
+
+    # replay deletes: anything not listed as live in this increment is gone
+    for collection_name, live_ids in live.items():
+        stale = [doc["_id"] async for doc in db[collection_name].find({}, {"_id": 1}) if doc["_id"] not in live_ids]
+        for offset in range(0, len(stale), 1000):
+            await db[collection_name].delete_many({"_id": {"$in": stale[offset:offset + 1000]}})
+
+
+async def restore_backup(name: str) -> list:
+    '''Restore the full backup behind `name`, then replay each increment up to it'''
+    chain = restore_chain(name)
+    for manifest in chain:
+        print(f"Restoring {manifest['file']} ({manifest['type']})")
+        await apply_archive(manifest)
+    return [manifest["name"] for manifest in chain]
+
+
+if __name__ == "__main__":
+    command = sys.argv[1:2]
+    if command == ["full"] or command == ["incremental"]:
+        asyncio.run(run_backup(command[0]))
+        print(json.dumps(public_progress(), indent=2))
+    elif command == ["restore"] and len(sys.argv) == 3:
+        asyncio.run(restore_backup(sys.argv[2]))
+    else:
+        sys.exit("usage: python -m routers.backup full|incremental|restore <name>")
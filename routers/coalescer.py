@@ -0,0 +1,104 @@
+import asyncio
+import time
+from decouple import config
+from pymongo.errors import BulkWriteError, WriteError
+
+from database import invoicedb as db
+from metrics import CREATE_BATCH_SIZE, CREATE_BATCH_WAIT
+from routers.numbering import allocator
+from routers.reports import apply_rollup_deltas
+
+# Group commit for POST /api/invoices/. Creates arriving within
+# CREATE_BATCH_WINDOW_MS of the first one in a batch (or until
+# CREATE_BATCH_MAX are waiting) take their numbers from this worker's block
+# (see routers/numbering.py), then share one insert_many and one rollup write. Each caller awaits its own future and gets its own
+# document back, or its own error if Mongo rejected just that document.
+# CREATE_BATCH_WINDOW_MS=0 turns this off and every create inserts on its own.
+
+CREATE_BATCH_WINDOW_MS = config('CREATE_BATCH_WINDOW_MS', cast=float, default=2)
+CREATE_BATCH_MAX = config('CREATE_BATCH_MAX', cast=int, default=100)
+
+invoice_collection = db.get_collection("invoices")
+
+
+class CreateCoalescer:
+    def __init__(self, window_ms: float = CREATE_BATCH_WINDOW_MS, max_batch: int = CREATE_BATCH_MAX):
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._pending = []  # (doc, future, enqueued_at)
+        self._timer = None
+        self._flushes = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def submit(self, doc: dict) -> dict:
+        '''Queue `doc` for the next batch; returns it with invoice_number and _id filled in'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((doc, future, time.perf_counter()))
+        if len(self._pending) >= self.max_batch:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_pending)
+        return await future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        CREATE_BATCH_SIZE.observe(len(batch))
+        for _, _, enqueued_at in batch:
+            CREATE_BATCH_WAIT.observe(started - enqueued_at)
+
+        docs = [doc for doc, _, _ in batch]
+        errors = {}
+        try:
+            for doc, number in zip(docs, await allocator.take(len(docs))):
+                doc["invoice_number"] = number
+            try:
+                await invoice_collection.insert_many(docs, ordered=False)
+            except BulkWriteError as exc:
+                # the other documents of the batch were still inserted
+                errors = {error["index"]: error for error in exc.details.get("writeErrors", [])}
+                if not errors:
+                    raise
+        except Exception as exc:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        inserted = [doc for index, doc in enumerate(docs) if index not in errors]
+        try:
+            await apply_rollup_deltas(inserted)
+        except Exception as exc:
+            # the invoices exist; a rollup rebuild repairs the totals
+            print(f"Rollup update failed for a batch of {len(inserted)} invoices: {exc}")
+
+        for index, (doc, future, _) in enumerate(batch):
+            if future.done():  # the caller went away
+                continue
+            if index in errors:
+                error = errors[index]
+                future.set_exception(WriteError(error.get("errmsg"), error.get("code"), error))
+            else:
+                future.set_result(doc)
+
+    async def drain(self):
+        '''Flush whatever is waiting and wait for in-flight batches (shutdown)'''
+        self._flush_pending()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+create_coalescer = CreateCoalescer()
@@ -0,0 +1,99 @@
+import csv
+import io
+import zlib
+from decouple import config
+
+# Streaming encoders for GET /api/invoices/export. Both consume a Motor cursor
+# and yield bytes as they go, so the full result set is never held in memory.
+
+EXPORT_BATCH_SIZE = config('EXPORT_BATCH_SIZE', cast=int, default=5000)
+EXPORT_COLUMNS = ["invoice_number", "name", "email", "amount", "created_at"]
+EXPORT_PROJECTION = {"_id": 0, **{column: 1 for column in EXPORT_COLUMNS}}
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet export is optional
+    pa = pq = None
+
+
+async def batches(cursor, size: int = EXPORT_BATCH_SIZE):
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def csv_gzip_chunks(cursor):
+    # wbits=31 writes a gzip header, so the output is a regular .csv.gz file
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    async for batch in batches(cursor):
+        writer.writerows(batch)
+        chunk = compressor.compress(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+        if chunk:
+            yield chunk
+    yield compressor.compress(buffer.getvalue().encode()) + compressor.flush()
+
+
+class _ChunkSink:
+    '''Write-only file object that pyarrow writes into and we drain per row group'''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema():
+    return pa.schema([
+        ("invoice_number", pa.string()),
+        ("name", pa.string()),
+        ("email", pa.string()),
+        ("amount", pa.float64()),
+        ("created_at", pa.timestamp("ms")),
+    ])
+
+
+async def parquet_chunks(cursor):
+    # every batch becomes one row group, flushed to the client before the next is read
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        async for batch in batches(cursor):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            if chunk := sink.drain():
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import random
+import socket
+import uuid
+from datetime import datetime, timedelta
+from decouple import config
+import httpx
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from database import invoicedb as db
+from metrics import FRAPPE_SYNC_DOCUMENTS, FRAPPE_SYNC_RETRIES, FRAPPE_SYNC_QUEUE_DEPTH
+from routers.auth.async_frappeclient import service_client
+from routers.auth.frappeclient import FrappeException
+
+# Mirrors invoices into Frappe as FRAPPE_INVOICE_DOCTYPE documents named by
+# invoice_number.
+#
+# A reader walks the invoices by (updated_at, _id) from the high-water mark
+# stored in sync_state and puts them on a queue of FRAPPE_SYNC_QUEUE_SIZE;
+# when Frappe falls behind the queue fills up and the reader waits. A pusher
+# takes whatever is queued and sends it with insert_many / bulk_update in
+# batches of FRAPPE_SYNC_INSERT_BATCH / FRAPPE_SYNC_UPDATE_BATCH. After a push
+# each invoice gets frappe_revision = revision, which is how the next change
+# knows the Frappe document exists (update, not insert) and how invoices
+# already pushed are skipped when they are read again.
+#
+# Calls that fail because Frappe is unreachable (or answers with an error page
+# instead of JSON) are retried with exponential backoff and full jitter, for as
+# long as it takes. A batch Frappe rejects is retried one invoice at a time so
+# a single bad invoice can't hold back the rest; the rejected ones are logged
+# and go out again with their next change.
+#
+# Each pass re-reads FRAPPE_SYNC_OVERLAP_SECONDS before the mark, so writes that
+# committed after a later one was read are still picked up. Only one worker
+# syncs at a time: it holds a lease in sync_state and renews it while running.
+# Deleting an invoice does not delete its Frappe document.
+
+FRAPPE_SYNC_ENABLED = config('FRAPPE_SYNC_ENABLED', cast=bool, default=False)
+FRAPPE_INVOICE_DOCTYPE = config('FRAPPE_INVOICE_DOCTYPE', default="Invoice")
+FRAPPE_SYNC_QUEUE_SIZE = config('FRAPPE_SYNC_QUEUE_SIZE', cast=int, default=1000)
+# Frappe's insert_many refuses more than 200 documents per call
+FRAPPE_SYNC_INSERT_BATCH = min(config('FRAPPE_SYNC_INSERT_BATCH', cast=int, default=100), 200)
+FRAPPE_SYNC_UPDATE_BATCH = config('FRAPPE_SYNC_UPDATE_BATCH', cast=int, default=100)
+FRAPPE_SYNC_POLL_SECONDS = config('FRAPPE_SYNC_POLL_SECONDS', cast=float, default=5)
+FRAPPE_SYNC_OVERLAP_SECONDS = config('FRAPPE_SYNC_OVERLAP_SECONDS', cast=float, default=30)
+FRAPPE_SYNC_BACKOFF_SECONDS = config('FRAPPE_SYNC_BACKOFF_SECONDS', cast=float, default=1)
+FRAPPE_SYNC_MAX_BACKOFF_SECONDS = config('FRAPPE_SYNC_MAX_BACKOFF_SECONDS', cast=float, default=60)
+FRAPPE_SYNC_LEASE_SECONDS = config('FRAPPE_SYNC_LEASE_SECONDS', cast=float, default=30)
+
+STATE_ID = "frappe_invoices"
+SYNC_SORT = [("updated_at", ASCENDING), ("_id", ASCENDING)]
+SYNC_PROJECTION = {
+    "invoice_number": 1, "name": 1, "email": 1, "amount": 1, "created_at": 1,
+    "revision": 1, "updated_at": 1, "frappe_revision": 1,
+}
+
+invoice_collection = db.get_collection("invoices")
+state_collection = db.get_collection("sync_state")
+
+
+def frappe_doc(invoice: dict) -> dict:
+    return {
+        "doctype": FRAPPE_INVOICE_DOCTYPE,
+        "name": invoice["invoice_number"],
+        "invoice_number": invoice["invoice_number"],
+        "customer_name": invoice.get("name"),
+        "email": invoice.get("email"),
+        "amount": float(invoice["amount"]) if invoice.get("amount") is not None else None,
+        "created_at": invoice["created_at"].isoformat() if invoice.get("created_at") else None,
+    }
+
+
+def revision(invoice: dict) -> int:
+    # documents written before revisions existed count as revision 0
+    return invoice.get("revision", 0)
+
+
+def backoff(attempt: int) -> float:
+    # full jitter, so workers coming back from the same outage don't retry in step
+    return random.uniform(0, min(FRAPPE_SYNC_MAX_BACKOFF_SECONDS, FRAPPE_SYNC_BACKOFF_SECONDS * 2 ** attempt))
+
+
+class FrappeSync:
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.frappe = None
+        self.queue = None
+        self._queued = {}  # _id -> revision, read but not pushed yet
+        self._position = None  # updated_at of the newest invoice read
+        self._high_water = None  # updated_at of the newest invoice pushed, as stored
+
+    async def run(self):
+        while True:
+            try:
+                if await self._acquire_lease():
+                    await self._lead()
+            except Exception as exc:
+                print(f"Frappe sync stopped: {exc}")
+            await asyncio.sleep(FRAPPE_SYNC_POLL_SECONDS)
+
+    async def _acquire_lease(self) -> bool:
+        '''Take the lease if it is free or expired, or renew ours'''
+        now = datetime.utcnow()
+        try:
+            await state_collection.update_one(
+                {"_id": STATE_ID, "$or": [{"owner": self.owner}, {"lease_until": None}, {"lease_until": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "lease_until": now + timedelta(seconds=FRAPPE_SYNC_LEASE_SECONDS)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False  # held by another worker
+        return True
+
+    async def _release_lease(self):
+        await state_collection.update_one(
+            {"_id": STATE_ID, "owner": self.owner}, {"$set": {"lease_until": datetime.utcnow()}},
+        )
+
+    async def _lead(self):
+        self.frappe = service_client()
+        tasks = []
+        try:
+            # bad credentials would otherwise look like Frappe rejecting every invoice
+            await self.frappe.get_api("frappe.auth.get_logged_user")
+
+            self.queue = asyncio.Queue(FRAPPE_SYNC_QUEUE_SIZE)
+            self._queued = {}
+            state = await state_collection.find_one({"_id": STATE_ID}) or {}
+            self._position = self._high_water = state.get("updated_at")
+            print(f"Frappe sync started from {self._position or 'the first invoice'}")
+
+            tasks = [asyncio.create_task(self._read()), asyncio.create_task(self._push())]
+            while True:
+                done, _ = await asyncio.wait(tasks, timeout=FRAPPE_SYNC_LEASE_SECONDS / 3, return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    for task in done:
+                        task.result()  # raises what stopped it
+                    return
+                if not await self._acquire_lease():
+                    print("Frappe sync lease taken over by another worker")
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            FRAPPE_SYNC_QUEUE_DEPTH.set(0)
+            await self.frappe.aclose()
+            try:
+                await self._release_lease()
+            except Exception as exc:
+                print(f"Frappe sync lease not released: {exc}")
+
+    async def _read(self):
+        while True:
+            query = {}
+            if self._position is not None:
+                query["updated_at"] = {"$gte": self._position - timedelta(seconds=FRAPPE_SYNC_OVERLAP_SECONDS)}
+            cursor = invoice_collection.find(
+                query, SYNC_PROJECTION, sort=SYNC_SORT, hint="updated_at_id", batch_size=FRAPPE_SYNC_QUEUE_SIZE,
+            )
+            async for invoice in cursor:
+                if invoice.get("updated_at") is not None and (self._position is None or invoice["updated_at"] > self._position):
+                    self._position = invoice["updated_at"]
+                if invoice.get("frappe_revision") == revision(invoice) or self._queued.get(invoice["_id"]) == revision(invoice):
+                    continue
+                self._queued[invoice["_id"]] = revision(invoice)
+                # blocks while the queue is full, i.e. while Frappe is behind
+                await self.queue.put(invoice)
+                FRAPPE_SYNC_QUEUE_DEPTH.set(self.queue.qsize())
+            await asyncio.sleep(FRAPPE_SYNC_POLL_SECONDS)
+
+    async def _push(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < max(FRAPPE_SYNC_INSERT_BATCH, FRAPPE_SYNC_UPDATE_BATCH) and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            FRAPPE_SYNC_QUEUE_DEPTH.set(self.queue.qsize())
+
+            # an invoice changed twice while queued only needs its latest revision
+            latest = {}
+            for invoice in batch:
+                if invoice["_id"] not in latest or revision(invoice) > revision(latest[invoice["_id"]]):
+                    latest[invoice["_id"]] = invoice
+            inserts = [invoice for invoice in latest.values() if "frappe_revision" not in invoice]
+            updates = [invoice for invoice in latest.values() if "frappe_revision" in invoice]
+            for offset in range(0, len(inserts), FRAPPE_SYNC_INSERT_BATCH):
+                await self._insert(inserts[offset:offset + FRAPPE_SYNC_INSERT_BATCH])
+            for offset in range(0, len(updates), FRAPPE_SYNC_UPDATE_BATCH):
+                await self._update(updates[offset:offset + FRAPPE_SYNC_UPDATE_BATCH])
+
+            for invoice in batch:
+                if self._queued.get(invoice["_id"]) == revision(invoice):
+                    del self._queued[invoice["_id"]]
+            await self._save_high_water(batch)
+
+    async def _call(self, method, *args):
+        '''Retries `method` until Frappe answers; FrappeException (a rejection) is raised'''
+        attempt = 0
+        while True:
+            try:
+                return await method(*args)
+            except (httpx.TransportError, ValueError) as exc:
+                # unreachable, or an error page from a proxy instead of JSON
+                delay = backoff(attempt)
+                attempt += 1
+                FRAPPE_SYNC_RETRIES.inc()
+                print(f"Frappe sync {method.__name__} failed ({exc!r}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _insert(self, invoices: list):
+        try:
+            await self._call(self.frappe.insert_many, [frappe_doc(invoice) for invoice in invoices])
+        except FrappeException as exc:
+            # insert_many is all or nothing, find the invoice(s) it refused
+            print(f"Frappe insert_many of {len(invoices)} invoices failed, pushing them one by one: {exc}")
+            await self._push_one_by_one(invoices)
+            return
+        FRAPPE_SYNC_DOCUMENTS.labels("insert", "synced").inc(len(invoices))
+        await self._mark(invoices)
+
+    async def _update(self, invoices: list):
+        docs = [{**frappe_doc(invoice), "docname": invoice["invoice_number"]} for invoice in invoices]
+        try:
+            result = await self._call(self.frappe.bulk_update, docs)
+        except FrappeException as exc:
+            print(f"Frappe bulk_update of {len(invoices)} invoices failed, pushing them one by one: {exc}")
+            await self._push_one_by_one(invoices)
+            return
+        # bulk_update saves what it can and lists the documents it could not
+        failed = {failure.get("doc", {}).get("docname") for failure in (result or {}).get("failed_docs", [])}
+        updated = [invoice for invoice in invoices if invoice["invoice_number"] not in failed]
+        FRAPPE_SYNC_DOCUMENTS.labels("update", "synced").inc(len(updated))
+        await self._mark(updated)
+        if failed:
+            await self._push_one_by_one([invoice for invoice in invoices if invoice["invoice_number"] in failed])
+
+    async def _push_one_by_one(self, invoices: list):
+        pushed = []
+        for invoice in invoices:
+            doc = frappe_doc(invoice)
+            # try the other operation second: the document may already exist
+            # (pushed before its marker was written) or may have been deleted in Frappe
+            operations = [("insert", self.frappe.insert), ("update", self.frappe.update)]
+            if "frappe_revision" in invoice:
+                operations.reverse()
+            for operation, method in operations:
+                try:
+                    await self._call(method, doc)
+                except FrappeException as exc:
+                    error = exc
+                    continue
+                FRAPPE_SYNC_DOCUMENTS.labels(operation, "synced").inc()
+                pushed.append(invoice)
+                break
+            else:
+                FRAPPE_SYNC_DOCUMENTS.labels(operations[0][0], "rejected").inc()
+                print(f"Frappe rejected invoice {invoice['invoice_number']}: {error}")
+        await self._mark(pushed)
+
+    async def _mark(self, invoices: list):
+        if not invoices:
+            return
+        # matched on revision, so a change written meanwhile still counts as unsynced
+        await invoice_collection.bulk_write([
+            UpdateOne({"_id": invoice["_id"], "revision": invoice.get("revision")}, {"$set": {"frappe_revision": revision(invoice)}})
+            for invoice in invoices
+        ], ordered=False)
+
+    async def _save_high_water(self, batch: list):
+        newest = max((invoice["updated_at"] for invoice in batch if invoice.get("updated_at") is not None), default=None)
+        if newest is None or (self._high_water is not None and newest <= self._high_water):
+            return
+        self._high_water = newest
+        await state_collection.update_one(
+            {"_id": STATE_ID}, {"$set": {"updated_at": newest, "synced_at": datetime.utcnow()}}, upsert=True,
+        )
+
+
+frappe_sync = FrappeSync()
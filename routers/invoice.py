@@ -1,15 +1,33 @@
-from fastapi import APIRouter, Body, HTTPException, status,Depends
+from fastapi import APIRouter, Body, HTTPException, status,Depends,Query,Request
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from fastapi.responses import Response,JSONResponse
-from pydantic import ConfigDict, BaseModel, Field, EmailStr
+from fastapi.responses import Response,JSONResponse,StreamingResponse,FileResponse
+from pydantic import ConfigDict, BaseModel, Field, EmailStr, ValidationError
 from pydantic.functional_validators import BeforeValidator
 from typing import Optional, List
 from typing_extensions import Annotated
 from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from decouple import config
 from pymongo import ReturnDocument
 from pymongo import ASCENDING, DESCENDING
-from datetime import datetime,timezone,timedelta
+from pymongo.errors import BulkWriteError, ExecutionTimeout
+from datetime import datetime,timezone
+import base64
+import hashlib
+import json
+import httpx
 from routers.utils import verify_token,get_current_user,check_roles
+from routers.numbering import allocator as number_allocator
+from routers.coalescer import create_coalescer
+from routers import export, search
+from routers.reports import apply_rollup_deltas, apply_rollup_change
+from routers.responses import MongoJSONResponse, MsgPackResponse, BSONResponse, dumps, negotiate
+from routers.pdf import pdf_cache, stream_and_cache, stream_uncached, FRAPPE_PRINT_FORMAT, FRAPPE_PDF_READ_TIMEOUT
+from routers.frappe_sync import FRAPPE_INVOICE_DOCTYPE, FRAPPE_SYNC_ENABLED, FRAPPE_SYNC_POLL_SECONDS
+from routers.auth.async_frappeclient import service_client
+from routers.auth.breaker import CircuitOpen
+from routers.auth.frappeclient import FrappeException
 # from routers.auth.auth import get_current_user
 
 
@@ -27,11 +45,27 @@ from routers.utils import verify_token,get_current_user,check_roles
 # include modal and method in same place
 
 # Import your database connection from app.py
-from database import invoicedb as db
+from database import invoicedb as db, read_collection
 
 router = APIRouter()
 
 invoice_collection = db.get_collection("invoices")
+# same collection, read with the listing / analytics read preference (see database.py)
+listing_collection = read_collection("invoices", "listing")
+analytics_collection = read_collection("invoices", "analytics")
+# Accept: application/bson is answered with the stored bytes, never decoded into dicts
+RAW_CODEC = CodecOptions(document_class=RawBSONDocument)
+
+def raw_collection(collection):
+    return collection.with_options(codec_options=RAW_CODEC)
+
+# documents pulled from the cursor and written to the response per chunk when streaming
+STREAM_BATCH_SIZE = config('STREAM_BATCH_SIZE', cast=int, default=500)
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson")
+BULK_MAX_ITEMS = config('BULK_MAX_ITEMS', cast=int, default=10000)
+BULK_BATCH_SIZE = config('BULK_BATCH_SIZE', cast=int, default=1000)
+# serialize Mongo documents directly (orjson when installed) instead of validating through InvoiceModel
+FAST_JSON = config('FAST_JSON', cast=bool, default=True)
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
@@ -74,23 +108,197 @@ class UpdateInvoiceModel(BaseModel):
 class InvoiceCollection(BaseModel):
     invoices: List[InvoiceModel]
 
+class InvoicePage(InvoiceCollection):
+    next_cursor: Optional[str] = None
+
+class SparseInvoiceModel(BaseModel):
+    # shape of a ?fields= response; only the requested fields are serialized
+    id: Optional[str] = None
+    invoice_number: Optional[str] = None
+    name: Optional[str] = None
+    email: Optional[EmailStr] = None
+    amount: Optional[float] = None
+    created_at: Optional[datetime] = None
+
+class BulkItemResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    invoice_number: Optional[str] = None
+    errors: Optional[List[dict]] = None
+
+class BulkInvoiceResult(BaseModel):
+    inserted: int
+    failed: int
+    results: List[BulkItemResult]
+
+
+INVOICE_FIELDS = tuple(field for field in InvoiceModel.model_fields if field != "id")
+PUBLIC_FIELDS = ("id",) + INVOICE_FIELDS
+
+def parse_fields(fields: Optional[str]) -> Optional[tuple]:
+    '''?fields=invoice_number,amount -> the requested fields in PUBLIC_FIELDS order'''
+    if not fields:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    if unknown := requested - set(PUBLIC_FIELDS):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}. Choose from {', '.join(PUBLIC_FIELDS)}",
+        )
+    return tuple(field for field in PUBLIC_FIELDS if field in requested) or None
+
+def fields_projection(fields: Optional[tuple], *always: str) -> Optional[dict]:
+    # _id and revision make up the ETag; `always` adds fields the route itself needs
+    if fields is None:
+        return None
+    return {"_id": 1, "revision": 1, **{field: 1 for field in fields + always if field != "id"}}
+
+def public_invoice(doc: dict, fields: Optional[tuple] = None) -> dict:
+    # same shape as InvoiceModel with response_model_by_alias=False, or only `fields`
+    invoice = {}
+    for field in fields or PUBLIC_FIELDS:
+        if field == "id":
+            invoice["id"] = str(doc["_id"]) if "_id" in doc else None
+        else:
+            invoice[field] = doc.get(field)
+    if invoice.get("amount") is not None:
+        invoice["amount"] = float(invoice["amount"])
+    return invoice
+
+def sparse_invoice(doc: dict, fields: tuple) -> dict:
+    if not FAST_JSON:
+        return SparseInvoiceModel.model_validate(public_invoice(doc, fields)).model_dump(mode="json", include=set(fields))
+    return public_invoice(doc, fields)
+
+def bson_projection(fields: Optional[tuple], *always: str) -> dict:
+    # public fields only (no revision/updated_at); "id" is the document's _id
+    wanted = (fields or PUBLIC_FIELDS) + always
+    return {"_id": int("id" in wanted), **{field: 1 for field in wanted if field != "id"}}
+
+def invoice_response(doc: dict, status_code: int = status.HTTP_200_OK, headers: Optional[dict] = None, fields: Optional[tuple] = None, encoding: str = "json"):
+    if encoding == "msgpack":
+        content = sparse_invoice(doc, fields) if fields else public_invoice(doc)
+        return MsgPackResponse(content, status_code=status_code, headers=headers)
+    if fields:
+        # trimmed documents bypass the route's InvoiceModel response_model
+        return MongoJSONResponse(sparse_invoice(doc, fields), status_code=status_code, headers=headers)
+    if not FAST_JSON:
+        if not headers:
+            return doc
+        content = InvoiceModel.model_validate(doc).model_dump(mode="json")
+        return JSONResponse(content, status_code=status_code, headers=headers)
+    return MongoJSONResponse(public_invoice(doc), status_code=status_code, headers=headers)
+
+def invoices_response(docs: List[dict], headers: Optional[dict] = None, fields: Optional[tuple] = None, encoding: str = "json", **extra):
+    if encoding == "msgpack":
+        invoices = [sparse_invoice(doc, fields) if fields else public_invoice(doc) for doc in docs]
+        return MsgPackResponse({"invoices": invoices, **extra}, headers=headers)
+    if fields:
+        return MongoJSONResponse({"invoices": [sparse_invoice(doc, fields) for doc in docs], **extra}, headers=headers)
+    if not FAST_JSON:
+        page = InvoicePage(invoices=docs, **extra) if extra else InvoiceCollection(invoices=docs)
+        return JSONResponse(page.model_dump(mode="json"), headers=headers) if headers else page
+    return MongoJSONResponse({"invoices": [public_invoice(doc) for doc in docs], **extra}, headers=headers)
+
+def dumps_invoice(doc: dict, fields: Optional[tuple] = None) -> str:
+    if fields:
+        return dumps(sparse_invoice(doc, fields)).decode()
+    if not FAST_JSON:
+        return InvoiceModel.model_validate(doc).model_dump_json()
+    return dumps(public_invoice(doc)).decode()
+
+
+# Every write bumps `revision`, so (_id, revision) identifies one version of an invoice.
+# Documents written before revisions existed count as revision 0.
+ETAG_PROJECTION = {"_id": 1, "revision": 1}
+
+def variant_tag(fields: Optional[tuple], encoding: str = "json") -> str:
+    # trimmed or binary representations are different entities than the full JSON one
+    fieldset = hashlib.sha1(",".join(fields).encode()).hexdigest()[:8] if fields else ""
+    return "-".join(part for part in (fieldset, "" if encoding == "json" else encoding) if part)
+
+def invoice_etag(doc: dict, fields: Optional[tuple] = None, encoding: str = "json") -> str:
+    if tag := variant_tag(fields, encoding):
+        return f'"{doc["_id"]}-{doc.get("revision", 0)}-{tag}"'
+    return f'"{doc["_id"]}-{doc.get("revision", 0)}"'
+
+def list_etag(docs: List[dict], fields: Optional[tuple] = None, encoding: str = "json") -> str:
+    digest = hashlib.sha1(variant_tag(fields, encoding).encode())
+    for doc in docs:
+        digest.update(f'{doc["_id"]}:{doc.get("revision", 0)};'.encode())
+    return f'"{digest.hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def read_headers(etag: str) -> dict:
+    # read routes negotiate JSON / MessagePack / BSON on Accept
+    return {"ETag": etag, "Vary": "Accept"}
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=read_headers(etag))
+
+async def find_invoices(request: Request, query: dict, fields: Optional[tuple] = None, projection: Optional[dict] = None, encoding: str = "json", **find_kwargs):
+    '''Returns (docs, etag); docs is None when the client's If-None-Match is still current'''
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # compare against _id/revision only before fetching and serializing whole documents
+        markers = await listing_collection.find(query, ETAG_PROJECTION, **find_kwargs).to_list(None)
+        etag = list_etag(markers, fields, encoding)
+        if etag_matches(if_none_match, etag):
+            return None, etag
+    docs = await listing_collection.find(query, projection, **find_kwargs).to_list(None)
+    return docs, list_etag(docs, fields, encoding)
+
+def bson_response(docs: List[RawBSONDocument], next_cursor: Optional[str] = None) -> BSONResponse:
+    # concatenated documents, like a mongodump .bson file; no ETag since revision is not sent
+    headers = {"Vary": "Accept"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return BSONResponse(b"".join(doc.raw for doc in docs), headers=headers)
+
+
+# keyset pagination: newest first, _id breaks ties between equal created_at
+PAGE_SORT = [("created_at", DESCENDING), ("_id", DESCENDING)]
+
+def encode_cursor(invoice: dict) -> str:
+    raw = json.dumps({"t": invoice["created_at"].isoformat(), "i": str(invoice["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at, _id = datetime.fromisoformat(raw["t"]), ObjectId(raw["i"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # everything strictly after the cursor position in PAGE_SORT order
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": _id}},
+    ]}
+
+def stored_datetime(value: datetime) -> datetime:
+    # what Mongo hands back on later reads: naive UTC with millisecond precision,
+    # so a create or update response matches a GET carrying the same ETag
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+def write_time() -> datetime:
+    # updated_at is when the write happened, never a client-supplied date, so
+    # whatever picks up changes by it also sees invoices with a backdated created_at.
+    # Mongo keeps milliseconds, trim so responses match later reads.
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
 async def generate_invoice_number():
-    utc_time = datetime.now(timezone.utc)
-    ist_time = utc_time + timedelta(hours=5, minutes=30)
-    date_string = ist_time.strftime("%d-%m-%Y")
-    
-    latest_invoice = await invoice_collection.find_one(
-        {"invoice_number": {"$regex": f"^INV-{date_string}"}},
-        sort=[("invoice_number", -1)]
-    )
-    
-    if latest_invoice:
-        latest_number = int(latest_invoice["invoice_number"].split("-")[-1])
-        new_number = latest_number + 1
-    else:
-        new_number = 1
-    
-    return f"INV-{date_string}-{new_number:04d}"
+    # one atomic $inc per block of numbers, see routers/numbering.py
+    return await number_allocator.next_number()
 
 @router.post(
     "/",
@@ -100,15 +308,128 @@ async def generate_invoice_number():
     response_model_by_alias=False,
 )
 async def create_invoice(invoice: InvoiceModel = Body(...),current_user: dict = Depends(get_current_user)):
-    invoice_number = await generate_invoice_number()
-    invoice.invoice_number = invoice_number
-    new_invoice = await invoice_collection.insert_one(
-        invoice.model_dump(by_alias=True, exclude=["id"])
-    )
-    created_invoice = await invoice_collection.find_one(
-        {"_id": new_invoice.inserted_id}
+    invoice.created_at = stored_datetime(invoice.created_at)
+    created_invoice = invoice.model_dump(by_alias=True, exclude=["id"])
+    created_invoice.update(revision=1, updated_at=write_time())
+    if create_coalescer.enabled:
+        # numbered, inserted and rolled up together with concurrent creates, see routers/coalescer.py
+        created_invoice = await create_coalescer.submit(created_invoice)
+        return invoice_response(created_invoice, status.HTTP_201_CREATED, {"ETag": invoice_etag(created_invoice)})
+    created_invoice["invoice_number"] = await generate_invoice_number()
+    # insert_one fills in created_invoice["_id"], no need to read the document back
+    await invoice_collection.insert_one(created_invoice)
+    await apply_rollup_deltas([created_invoice])
+    return invoice_response(created_invoice, status.HTTP_201_CREATED, {"ETag": invoice_etag(created_invoice)})
+
+async def read_bulk_items(request: Request) -> List:
+    # NDJSON is parsed line by line as it arrives, anything else must be a JSON array
+    if any(media_type in request.headers.get("content-type", "") for media_type in NDJSON_MEDIA_TYPES):
+        items, pending = [], b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            items.extend(line for line in lines if line.strip())
+            if len(items) > BULK_MAX_ITEMS:
+                break
+        if pending.strip():
+            items.append(pending)
+    else:
+        try:
+            items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} invoices per request")
+    return items
+
+def validate_bulk_batch(items: List, offset: int, results: List[BulkItemResult]) -> List[tuple]:
+    valid = []
+    for index, item in enumerate(items, start=offset):
+        try:
+            if isinstance(item, bytes):
+                item = json.loads(item)
+            valid.append((index, InvoiceModel.model_validate(item)))
+        except ValidationError as exc:
+            results.append(BulkItemResult(index=index, errors=json.loads(exc.json(include_url=False))))
+        except ValueError as exc:
+            results.append(BulkItemResult(index=index, errors=[{"type": "json_invalid", "msg": str(exc)}]))
+    return valid
+
+@router.post(
+    "/bulk",
+    response_description="Add many invoices in one request",
+    response_model=BulkInvoiceResult,
+    status_code=status.HTTP_201_CREATED,
+    responses={207: {"model": BulkInvoiceResult, "description": "Some invoices were rejected"}},
+)
+async def create_invoices_bulk(request: Request, current_user: dict = Depends(get_current_user)):
+    items = await read_bulk_items(request)
+    results: List[BulkItemResult] = []
+
+    valid = []
+    for offset in range(0, len(items), BULK_BATCH_SIZE):
+        valid.extend(validate_bulk_batch(items[offset:offset + BULK_BATCH_SIZE], offset, results))
+
+    # one $inc for the whole request, numbers are contiguous in input order
+    invoice_numbers = await number_allocator.reserve(len(valid))
+    for (index, invoice), invoice_number in zip(valid, invoice_numbers):
+        invoice.invoice_number = invoice_number
+        invoice.created_at = stored_datetime(invoice.created_at)
+
+    inserted = 0
+    inserted_docs = []
+    updated_at = write_time()
+    for offset in range(0, len(valid), BULK_BATCH_SIZE):
+        batch = valid[offset:offset + BULK_BATCH_SIZE]
+        docs = [
+            {**invoice.model_dump(by_alias=True, exclude=["id"]), "revision": 1, "updated_at": updated_at}
+            for _, invoice in batch
+        ]
+        failed = {}
+        try:
+            await invoice_collection.insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            failed = {error["index"]: error for error in exc.details.get("writeErrors", [])}
+        for position, ((index, invoice), doc) in enumerate(zip(batch, docs)):
+            if position in failed:
+                error = failed[position]
+                results.append(BulkItemResult(index=index, invoice_number=invoice.invoice_number,
+                    errors=[{"type": "write_error", "code": error.get("code"), "msg": error.get("errmsg")}]))
+            else:
+                inserted += 1
+                inserted_docs.append(doc)
+                results.append(BulkItemResult(index=index, id=str(doc["_id"]), invoice_number=invoice.invoice_number))
+
+    await apply_rollup_deltas(inserted_docs)
+
+    results.sort(key=lambda result: result.index)
+    body = BulkInvoiceResult(inserted=inserted, failed=len(results) - inserted, results=results)
+    return JSONResponse(
+        status_code=status.HTTP_201_CREATED if body.failed == 0 else status.HTTP_207_MULTI_STATUS,
+        content=body.model_dump(exclude_none=True),
     )
-    return created_invoice
+
+def join_stream_batch(batch: List[str], ndjson: bool, continued: bool) -> str:
+    if ndjson:
+        return "\n".join(batch) + "\n"
+    return ("," if continued else "") + ",".join(batch)
+
+async def stream_invoices(cursor, ndjson: bool, fields: Optional[tuple] = None):
+    # serialize batch by batch so memory stays flat however many invoices there are
+    if not ndjson:
+        yield '{"invoices":['
+    batch, continued = [], False
+    async for doc in cursor:
+        batch.append(dumps_invoice(doc, fields))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield join_stream_batch(batch, ndjson, continued)
+            batch, continued = [], True
+    if batch:
+        yield join_stream_batch(batch, ndjson, continued)
+    if not ndjson:
+        yield "]}"
 
 @router.get(
     "/",
@@ -117,12 +438,55 @@ async def create_invoice(invoice: InvoiceModel = Body(...),current_user: dict =
     response_model_by_alias=False,
 )
 @check_roles(["admin", "HR","Employee"])
-async def list_invoices(current_user: dict = Depends(get_current_user)):
+async def list_invoices(
+    request: Request,
+    stream: Optional[str] = Query(None, pattern="^(ndjson|json)$", description="Stream all invoices as NDJSON or a chunked JSON body"),
+    email: Optional[EmailStr] = None,
+    name_prefix: Optional[str] = Query(None, description="Case-sensitive prefix of the customer name"),
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    sort: str = Query("-created_at", pattern=search.SORT_PATTERN),
+    limit: int = Query(1000, ge=1, le=1000),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. invoice_number,amount"),
+    current_user: dict = Depends(get_current_user),
+):
     # sort_order = DESCENDING  # or ASCENDING for ascending order
     # invoices = await invoice_collection.find().sort("created_at", sort_order).to_list(1000)
     # return InvoiceCollection(invoices=invoices)
+    fields = parse_fields(fields)
+    accept = request.headers.get("accept", "")
+    encoding = negotiate(accept)
+    if stream is None and any(media_type in accept for media_type in NDJSON_MEDIA_TYPES):
+        stream = "ndjson"
+    plan = search.plan_search(email, name_prefix, min_amount, max_amount, created_from, created_to, sort, streamed=bool(stream))
+    if stream:
+        # no 1000 cap here, the cursor is drained in batches while the response is written
+        cursor = listing_collection.find(
+            plan["query"], fields_projection(fields), sort=plan["sort"], hint=plan["hint"], batch_size=STREAM_BATCH_SIZE
+        )
+        ndjson = stream == "ndjson"
+        return StreamingResponse(
+            stream_invoices(cursor, ndjson, fields),
+            media_type=NDJSON_MEDIA_TYPES[0] if ndjson else "application/json",
+        )
     try:
-        return InvoiceCollection(invoices=await invoice_collection.find().to_list(1000))
+        if encoding == "bson":
+            invoices = await raw_collection(listing_collection).find(
+                plan["query"], bson_projection(fields),
+                sort=plan["sort"], hint=plan["hint"], limit=limit, max_time_ms=search.SEARCH_MAX_TIME_MS,
+            ).to_list(None)
+            return bson_response(invoices)
+        invoices, etag = await find_invoices(
+            request, plan["query"], fields, fields_projection(fields), encoding,
+            sort=plan["sort"], hint=plan["hint"], limit=limit, max_time_ms=search.SEARCH_MAX_TIME_MS,
+        )
+        if invoices is None:
+            return not_modified(etag)
+        return invoices_response(invoices, headers=read_headers(etag), fields=fields, encoding=encoding)
+    except ExecutionTimeout:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=search.TOO_BROAD)
     except HTTPException as http_exc:
         return {"error": http_exc.detail, "status_code": http_exc.status_code}
     except Exception as exc:
@@ -130,12 +494,80 @@ async def list_invoices(current_user: dict = Depends(get_current_user)):
     
 @router.get(
     "/get_pagination",
-    response_description="List all invoices",
-    response_model=InvoiceCollection,
+    response_description="List invoices one page at a time",
+    response_model=InvoicePage,
     response_model_by_alias=False,
 )
-async def list_pagination_invoice(skip: int = 0, limit: int = 10,current_user: dict = Depends(get_current_user)):
-    return InvoiceCollection(invoices=await invoice_collection.find(skip=skip, limit=limit).to_list(limit-skip))
+async def list_pagination_invoice(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=1000),
+    skip: int = Query(0, ge=0),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. invoice_number,amount"),
+    current_user: dict = Depends(get_current_user),
+):
+    fields = parse_fields(fields)
+    encoding = negotiate(request.headers.get("accept", ""))
+    # the next cursor is built from created_at, so it is fetched even when not returned
+    projection = fields_projection(fields, "created_at")
+    # legacy skip/limit paging, cost grows with skip
+    if skip and not cursor:
+        if encoding == "bson":
+            invoices = await raw_collection(listing_collection).find({}, bson_projection(fields), sort=PAGE_SORT, skip=skip, limit=limit).to_list(None)
+            return bson_response(invoices)
+        invoices, etag = await find_invoices(request, {}, fields, projection, encoding, sort=PAGE_SORT, skip=skip, limit=limit)
+        if invoices is None:
+            return not_modified(etag)
+        return invoices_response(invoices, headers=read_headers(etag), fields=fields, encoding=encoding, next_cursor=None)
+
+    query = decode_cursor(cursor) if cursor else {}
+    # one extra document tells us whether there is a next page
+    if encoding == "bson":
+        # BSON pages always carry _id and created_at, the cursor is read from the last document
+        invoices = await raw_collection(listing_collection).find(
+            query, bson_projection(fields, "id", "created_at"), sort=PAGE_SORT, limit=limit + 1
+        ).to_list(None)
+        if len(invoices) > limit:
+            return bson_response(invoices[:limit], encode_cursor(invoices[limit - 1]))
+        return bson_response(invoices)
+    invoices, etag = await find_invoices(request, query, fields, projection, encoding, sort=PAGE_SORT, limit=limit + 1)
+    if invoices is None:
+        return not_modified(etag)
+    next_cursor = None
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        next_cursor = encode_cursor(invoices[-1])
+    return invoices_response(invoices, headers=read_headers(etag), fields=fields, encoding=encoding, next_cursor=next_cursor)
+
+@router.get("/export", response_description="Export invoices as gzipped CSV or Parquet")
+@check_roles(["admin", "HR","Employee"])
+async def export_invoices(
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    email: Optional[EmailStr] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    if format == "parquet" and export.pq is None:
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+
+    # filters and projection run in Mongo, rows are encoded while the cursor is read
+    plan = search.plan_search(email=email, created_from=created_from, created_to=created_to, streamed=True)
+    cursor = analytics_collection.find(
+        plan["query"], export.EXPORT_PROJECTION, sort=plan["sort"], hint=plan["hint"],
+        batch_size=export.EXPORT_BATCH_SIZE,
+    )
+    if format == "parquet":
+        return StreamingResponse(
+            export.parquet_chunks(cursor),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": 'attachment; filename="invoices.parquet"'},
+        )
+    return StreamingResponse(
+        export.csv_gzip_chunks(cursor),
+        media_type="application/gzip",
+        headers={"Content-Disposition": 'attachment; filename="invoices.csv.gz"'},
+    )
 
 @router.get(
     "/{invoice_number}",
@@ -143,13 +575,87 @@ async def list_pagination_invoice(skip: int = 0, limit: int = 10,current_user: d
     response_model=InvoiceModel,
     response_model_by_alias=False,
 )
-async def show_invoice(invoice_number: str,current_user: dict = Depends(get_current_user)):
+async def show_invoice(
+    invoice_number: str,
+    request: Request,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. invoice_number,amount"),
+    current_user: dict = Depends(get_current_user),
+):
+    fields = parse_fields(fields)
+    encoding = negotiate(request.headers.get("accept", ""))
+    if encoding == "bson":
+        raw = await raw_collection(invoice_collection).find_one({"invoice_number": invoice_number}, bson_projection(fields))
+        if raw is None:
+            raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
+        return bson_response([raw])
+    if if_none_match := request.headers.get("if-none-match"):
+        marker = await invoice_collection.find_one({"invoice_number": invoice_number}, ETAG_PROJECTION)
+        if marker is None:
+            raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
+        if etag_matches(if_none_match, invoice_etag(marker, fields, encoding)):
+            return not_modified(invoice_etag(marker, fields, encoding))
     if (
-        invoice := await invoice_collection.find_one({"invoice_number": invoice_number})
+        invoice := await invoice_collection.find_one({"invoice_number": invoice_number}, fields_projection(fields))
     ) is not None:
-        return invoice
+        etag = invoice_etag(invoice, fields, encoding)
+        return invoice_response(invoice, headers=read_headers(etag), fields=fields, encoding=encoding)
     raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
 
+@router.get("/{invoice_number}/pdf", response_description="Download the invoice PDF rendered by Frappe")
+@check_roles(["admin", "HR","Employee"])
+async def invoice_pdf(
+    invoice_number: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+):
+    marker = await invoice_collection.find_one(
+        {"invoice_number": invoice_number}, {"invoice_number": 1, "frappe_revision": 1, **ETAG_PROJECTION}
+    )
+    if marker is None:
+        raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
+    etag = invoice_etag(marker, None, "pdf")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    # Frappe renders its own copy of the invoice, which the sync brings up to date
+    # after the write; only a rendering of the current revision is cached or tagged
+    in_sync = marker.get("frappe_revision") == marker.get("revision", 0)
+    if not in_sync and FRAPPE_SYNC_ENABLED and "frappe_revision" not in marker:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The invoice has not reached Frappe yet. Please try again shortly.",
+            headers={"Retry-After": str(int(FRAPPE_SYNC_POLL_SECONDS) + 1)},
+        )
+    headers = {"Content-Disposition": f'attachment; filename="{invoice_number}.pdf"'}
+    if in_sync:
+        headers["ETag"] = etag
+        name = pdf_cache.key(invoice_number, marker.get("revision", 0), FRAPPE_PRINT_FORMAT)
+        if (path := pdf_cache.get(name)) is not None:
+            return FileResponse(path, media_type="application/pdf", headers=headers)
+    else:
+        headers["Cache-Control"] = "no-store"
+
+    # not rendered for this revision yet: pass Frappe's response through chunk by chunk
+    frappe = service_client()
+    try:
+        response = await frappe.get_pdf_stream(
+            FRAPPE_INVOICE_DOCTYPE, invoice_number, FRAPPE_PRINT_FORMAT, read_timeout=FRAPPE_PDF_READ_TIMEOUT,
+        )
+    except FrappeException as exc:
+        await frappe.aclose()
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Frappe could not render the PDF: {exc}")
+    except httpx.TransportError as exc:
+        await frappe.aclose()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Unable to connect to Frappe server. Please try again later.",
+            headers={"Retry-After": str(int(exc.retry_after) + 1)} if isinstance(exc, CircuitOpen) else None,
+        )
+    if "content-length" in response.headers and "content-encoding" not in response.headers:
+        headers["Content-Length"] = response.headers["content-length"]
+    body = stream_and_cache(response, frappe, name) if in_sync else stream_uncached(response, frappe)
+    return StreamingResponse(body, media_type="application/pdf", headers=headers)
+
 @router.put(
     "/{invoice_number}",
     response_description="Update an invoice",
@@ -161,23 +667,28 @@ async def update_invoice(invoice_number: str, invoice: UpdateInvoiceModel = Body
         k: v for k, v in invoice.model_dump(by_alias=True).items() if v is not None
     }
     if len(invoice) >= 1:
-        update_result = await invoice_collection.find_one_and_update(
+        # the previous version is needed to move amount/email between rollup buckets
+        updated_at = write_time()
+        previous = await invoice_collection.find_one_and_update(
             {"invoice_number": invoice_number},
-            {"$set": invoice},
-            return_document=ReturnDocument.AFTER,
+            {"$set": {**invoice, "updated_at": updated_at}, "$inc": {"revision": 1}},
+            return_document=ReturnDocument.BEFORE,
         )
-        if update_result is not None:
-            return update_result
+        if previous is not None:
+            update_result = {**previous, **invoice, "updated_at": updated_at, "revision": previous.get("revision", 0) + 1}
+            await apply_rollup_change(previous, update_result)
+            return invoice_response(update_result, headers={"ETag": invoice_etag(update_result)})
         else:
             raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
     if (existing_invoice := await invoice_collection.find_one({"invoice_number": invoice_number})) is not None:
-        return existing_invoice
+        return invoice_response(existing_invoice, headers={"ETag": invoice_etag(existing_invoice)})
     raise HTTPException(status_code=404, detail=f"Invoice {invoice_number} not found")
 
 @router.delete("/{invoice_number}", response_description="Delete an invoice")
 async def delete_invoice(invoice_number: str,current_user: dict = Depends(get_current_user)):
-    delete_result = await invoice_collection.delete_one({"invoice_number": invoice_number})
-    if delete_result.deleted_count == 1:
+    deleted_invoice = await invoice_collection.find_one_and_delete({"invoice_number": invoice_number})
+    if deleted_invoice is not None:
+        await apply_rollup_deltas([deleted_invoice], -1)
         return JSONResponse(
                 status_code=status.HTTP_200_OK,
                 content={"message": f"Invoice {invoice_number} has been deleted successfully."}
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from decouple import config
+from pymongo import ReturnDocument
+
+from database import invoicedb as db
+
+# Invoice numbers are handed out from one counter document per IST day:
+#   {"_id": "invoice:22-02-2023", "seq": 42}
+# A single atomic $inc reserves a block of numbers for this worker, so a burst
+# of creates only goes to Mongo once per block instead of once per invoice.
+# Numbers left in a block when the worker restarts are skipped, so the
+# sequence can have gaps but never duplicates. Set INVOICE_NUMBER_BLOCK=1 for
+# strictly contiguous numbering.
+
+counter_collection = db.get_collection("counters")
+invoice_collection = db.get_collection("invoices")
+
+INVOICE_NUMBER_BLOCK = config('INVOICE_NUMBER_BLOCK', cast=int, default=10)
+
+
+def ist_date_string(now: datetime | None = None) -> str:
+    utc_time = now or datetime.now(timezone.utc)
+    ist_time = utc_time + timedelta(hours=5, minutes=30)
+    return ist_time.strftime("%d-%m-%Y")
+
+
+def format_invoice_number(date_string: str, number: int) -> str:
+    return f"INV-{date_string}-{number:04d}"
+
+
+def counter_id(date_string: str) -> str:
+    return f"invoice:{date_string}"
+
+
+class InvoiceNumberAllocator:
+    def __init__(self, block_size: int = INVOICE_NUMBER_BLOCK):
+        self.block_size = max(1, block_size)
+        self._lock = asyncio.Lock()
+        self._date_string = None
+        self._next = 0
+        self._high = 0
+
+    async def _reserve_range(self, date_string: str, count: int) -> int:
+        # returns the last number of the reserved range
+        counter = await counter_collection.find_one_and_update(
+            {"_id": counter_id(date_string)},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["seq"]
+
+    async def next_number(self) -> str:
+        return (await self.take(1))[0]
+
+    async def take(self, count: int) -> list[str]:
+        '''`count` numbers from this worker's block; one $inc of max(missing, block size) refills it'''
+        if count <= 0:
+            return []
+        numbers = []
+        async with self._lock:
+            date_string = ist_date_string()
+            if date_string != self._date_string:
+                # a new day starts its own sequence, the old block is dropped
+                self._date_string, self._next, self._high = date_string, 1, 0
+            while len(numbers) < count:
+                if self._next > self._high:
+                    size = max(count - len(numbers), self.block_size)
+                    self._high = await self._reserve_range(date_string, size)
+                    self._next = self._high - size + 1
+                taken = min(count - len(numbers), self._high - self._next + 1)
+                numbers.extend(range(self._next, self._next + taken))
+                self._next += taken
+        return [format_invoice_number(date_string, number) for number in numbers]
+
+    async def reserve(self, count: int) -> list[str]:
+        '''Reserve `count` contiguous numbers with a single $inc (used by bulk inserts)'''
+        if count <= 0:
+            return []
+        date_string = ist_date_string()
+        high = await self._reserve_range(date_string, count)
+        return [format_invoice_number(date_string, n) for n in range(high - count + 1, high + 1)]
+
+
+allocator = InvoiceNumberAllocator()
+
+
+# migration: seed counters from the invoices that already exist
+async def seed_invoice_counters(date_string: str | None = None) -> dict:
+    '''Raise each day's counter to the highest invoice number already stored.
+
+    Uses $max so it is safe to run repeatedly and never moves a counter back.
+    Pass `date_string` (dd-mm-YYYY) to seed a single day.'''
+    date_pattern = date_string or r"\d{2}-\d{2}-\d{4}"
+    match = {"invoice_number": {"$regex": f"^INV-{date_pattern}-\\d+$"}}
+    pipeline = [
+        {"$match": match},
+        {"$project": {
+            "date": {"$substrCP": ["$invoice_number", 4, 10]},
+            "seq": {"$toInt": {"$substrCP": ["$invoice_number", 15, {"$strLenCP": "$invoice_number"}]}},
+        }},
+        {"$group": {"_id": "$date", "seq": {"$max": "$seq"}}},
+    ]
+    seeded = {}
+    async for row in invoice_collection.aggregate(pipeline):
+        await counter_collection.update_one(
+            {"_id": counter_id(row["_id"])},
+            {"$max": {"seq": row["seq"]}},
+            upsert=True,
+        )
+        seeded[row["_id"]] = row["seq"]
+    return seeded
+
+
+if __name__ == "__main__":
+    seeded = asyncio.run(seed_invoice_counters())
+    for date_string, seq in sorted(seeded.items()):
+        print(f"{date_string}: {seq}")
+    print(f"Seeded {len(seeded)} invoice counters")
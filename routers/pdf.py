@@ -0,0 +1,177 @@
+import asyncio
+import os
+import re
+import time
+import uuid
+from decouple import config
+
+# Invoice PDFs rendered by Frappe, streamed to the client and cached on disk.
+#
+# A cache entry is PDF_CACHE_DIR/<invoice_number>--r<revision>--<format>.pdf.
+# Every invoice write bumps `revision`, but Frappe renders its own copy of the
+# invoice, which the sync (routers/frappe_sync.py) updates afterwards. So a
+# PDF is only cached while the invoice's frappe_revision equals its revision;
+# until then it is streamed from Frappe uncached. Storing a revision removes
+# the older ones in the same format, and a download that finishes after a
+# newer revision was stored is dropped. The least recently served files are evicted once the directory grows past
+# PDF_CACHE_MAX_BYTES. File mtimes record use, and lookups and eviction work
+# from the directory itself, so all workers share one cache and its order
+# survives restarts.
+
+PDF_CACHE_DIR = config('PDF_CACHE_DIR', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pdf_cache'))
+PDF_CACHE_MAX_BYTES = config('PDF_CACHE_MAX_BYTES', cast=int, default=512 * 1024 * 1024)
+PDF_CHUNK_SIZE = config('PDF_CHUNK_SIZE', cast=int, default=64 * 1024)
+FRAPPE_PRINT_FORMAT = config('FRAPPE_PRINT_FORMAT', default="Standard")
+# rendering is slow, it gets a longer read timeout than other Frappe calls
+FRAPPE_PDF_READ_TIMEOUT = config('FRAPPE_PDF_READ_TIMEOUT', cast=float, default=60)
+# a download in progress writes at least once per read timeout; a .part file
+# untouched for longer was left behind by a worker that died mid-download
+PART_MAX_AGE_SECONDS = 2 * FRAPPE_PDF_READ_TIMEOUT
+
+
+def _safe(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", value)
+
+
+KEY_PATTERN = re.compile(r"^(?P<invoice>.+)--r(?P<revision>\d+)--(?P<format>.+)\.pdf$")
+
+
+def parse_key(name: str):
+    '''(invoice, revision, format) of a cache file name, None for anything else'''
+    match = KEY_PATTERN.match(name)
+    if match is None:
+        return None
+    return match["invoice"], int(match["revision"]), match["format"]
+
+
+class PdfCache:
+    def __init__(self, directory: str = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(invoice_number: str, revision: int, print_format: str) -> str:
+        return f"{_safe(invoice_number)}--r{revision}--{_safe(print_format)}.pdf"
+
+    def load(self):
+        '''Create the cache directory and clear abandoned downloads; blocking, run it in a thread'''
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, name: str):
+        '''Path of a cached PDF, or None; whichever worker stored it'''
+        path = self.path(name)
+        try:
+            os.utime(path)  # mark it recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def part_path(self, name: str) -> str:
+        # unique per download, concurrent misses on the same PDF don't collide
+        return self.path(f"{name}.{uuid.uuid4().hex}.part")
+
+    def _scan(self) -> list:
+        '''(mtime, name, size) of the cached PDFs, oldest first; removes abandoned .part files'''
+        files = []
+        stale_before = time.time() - PART_MAX_AGE_SECONDS
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".part"):
+                    if stat.st_mtime < stale_before:
+                        os.unlink(entry.path)
+                elif entry.name.endswith(".pdf"):
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                pass  # evicted by another worker while we looked
+        return sorted(files)
+
+    def _evict(self, name: str):
+        invoice, revision, print_format = parse_key(name)
+        stale, kept = [], []
+        for _, other, size in self._scan():
+            parsed = parse_key(other)
+            if other != name and parsed is not None and parsed[0] == invoice and parsed[2] == print_format:
+                # one revision per invoice and format; a newer one (stored by a
+                # concurrent download) wins over the file just stored
+                if parsed[1] < revision:
+                    stale.append(other)
+                    continue
+                if parsed[1] > revision:
+                    stale.append(name)
+            kept.append((other, size))
+        kept = [(other, size) for other, size in kept if other not in stale]
+        total = sum(size for _, size in kept)
+        # least recently used first, and never the file just stored
+        for other, size in kept:
+            if total <= self.max_bytes:
+                break
+            if other != name:
+                stale.append(other)
+                total -= size
+        self._unlink(stale)
+
+    def _newer_cached(self, name: str) -> bool:
+        invoice, revision, print_format = parse_key(name)
+        for entry in os.scandir(self.directory):
+            parsed = parse_key(entry.name)
+            if parsed is not None and parsed[0] == invoice and parsed[2] == print_format and parsed[1] > revision:
+                return True
+        return False
+
+    def _publish(self, name: str, part_path: str):
+        if self._newer_cached(name):
+            # a slow download of an older revision, a newer one is already served
+            self._unlink([os.path.basename(part_path)])
+            return
+        os.replace(part_path, self.path(name))
+        self._evict(name)
+
+    async def store(self, name: str, part_path: str):
+        '''Publish a completed download and evict whatever no longer fits'''
+        await asyncio.to_thread(self._publish, name, part_path)
+
+    def _unlink(self, names):
+        for name in names:
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+
+
+pdf_cache = PdfCache()
+
+
+async def stream_and_cache(response, frappe, name: str):
+    '''Yields the PDF from Frappe in PDF_CHUNK_SIZE chunks while writing it to the cache'''
+    part_path = pdf_cache.part_path(name)
+    complete = False
+    f = await asyncio.to_thread(open, part_path, "wb")
+    try:
+        async for chunk in response.aiter_bytes(PDF_CHUNK_SIZE):
+            await asyncio.to_thread(f.write, chunk)
+            yield chunk
+        complete = True
+    finally:
+        await asyncio.to_thread(f.close)
+        await response.aclose()
+        await frappe.aclose()
+        if complete:
+            await pdf_cache.store(name, part_path)
+        else:
+            # client went away or Frappe broke off, don't cache a partial PDF
+            await asyncio.to_thread(pdf_cache._unlink, [os.path.basename(part_path)])
+
+
+async def stream_uncached(response, frappe):
+    '''Yields the PDF from Frappe in PDF_CHUNK_SIZE chunks without keeping a copy'''
+    try:
+        async for chunk in response.aiter_bytes(PDF_CHUNK_SIZE):
+            yield chunk
+    finally:
+        await response.aclose()
+        await frappe.aclose()
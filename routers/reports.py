@@ -0,0 +1,168 @@
+import asyncio
+import sys
+from collections import defaultdict
+from datetime import timedelta, timezone
+from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel, EmailStr
+from pymongo import UpdateOne, ASCENDING
+from typing import Optional, List
+
+from database import invoicedb as db, read_collection
+from routers.utils import get_current_user, check_roles
+
+# Invoice totals are kept in invoice_rollups, one document per bucket:
+#   {"_id": "day:2024-02-22", "kind": "day", "key": "2024-02-22", "count": 3, "amount": 301.5}
+# Invoice writes $inc the buckets they touch, so report reads cost O(buckets)
+# instead of O(invoices). Days and months are IST, like invoice numbers.
+# The invoice write and its rollup $inc are not one transaction; if they ever
+# drift apart, `just rebuild-rollups` recomputes everything from the invoices.
+
+router = APIRouter()
+
+rollup_collection = db.get_collection("invoice_rollups")
+invoice_collection = db.get_collection("invoices")
+# report reads tolerate replication lag, rollup writes and rebuilds stay on the primary
+rollup_reads = read_collection("invoice_rollups", "analytics")
+
+ROLLUP_KINDS = ("day", "month", "email")
+IST = timezone(timedelta(hours=5, minutes=30))
+
+
+class RollupBucket(BaseModel):
+    key: str
+    count: int
+    amount: float
+
+
+class RollupReport(BaseModel):
+    kind: str
+    buckets: List[RollupBucket]
+
+
+def rollup_keys(invoice: dict) -> dict:
+    created_at = invoice["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    ist_time = created_at.astimezone(IST)
+    return {
+        "day": ist_time.strftime("%Y-%m-%d"),
+        "month": ist_time.strftime("%Y-%m"),
+        "email": invoice["email"],
+    }
+
+
+async def apply_rollup_deltas(invoices: List[dict], sign: int = 1):
+    '''Add (sign=1) or remove (sign=-1) invoices from their buckets in one bulk write'''
+    deltas = defaultdict(lambda: [0, 0.0])
+    for invoice in invoices:
+        for kind, key in rollup_keys(invoice).items():
+            delta = deltas[(kind, key)]
+            delta[0] += sign
+            delta[1] += sign * invoice["amount"]
+    if not deltas:
+        return
+    await rollup_collection.bulk_write([
+        UpdateOne(
+            {"_id": f"{kind}:{key}"},
+            {"$inc": {"count": count, "amount": amount}, "$setOnInsert": {"kind": kind, "key": key}},
+            upsert=True,
+        )
+        for (kind, key), (count, amount) in deltas.items()
+    ], ordered=False)
+
+
+async def apply_rollup_change(before: dict, after: dict):
+    if rollup_keys(before) == rollup_keys(after) and before["amount"] == after["amount"]:
+        return
+    await apply_rollup_deltas([before], -1)
+    await apply_rollup_deltas([after], 1)
+
+
+def rebuild_pipeline(kind: str, into: str) -> list:
+    if kind == "email":
+        key = "$email"
+    else:
+        key = {"$dateToString": {
+            "format": "%Y-%m-%d" if kind == "day" else "%Y-%m",
+            "date": "$created_at",
+            "timezone": "+05:30",
+        }}
+    return [
+        {"$group": {"_id": key, "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}},
+        {"$project": {
+            "_id": {"$concat": [f"{kind}:", "$_id"]},
+            "kind": kind,
+            "key": "$_id",
+            "count": 1,
+            "amount": 1,
+        }},
+        {"$merge": {"into": into}},
+    ]
+
+
+async def rebuild_rollups() -> dict:
+    '''Recompute every bucket from the invoices and swap the result in'''
+    staging = db.get_collection("invoice_rollups_rebuild")
+    await staging.drop()
+    for kind in ROLLUP_KINDS:
+        async for _ in invoice_collection.aggregate(rebuild_pipeline(kind, staging.name)):
+            pass
+    counts = {kind: await staging.count_documents({"kind": kind}) for kind in ROLLUP_KINDS}
+    if sum(counts.values()):
+        await staging.create_index([("kind", ASCENDING), ("key", ASCENDING)], name="kind_key")
+        await staging.rename(rollup_collection.name, dropTarget=True)
+    else:
+        await rollup_collection.delete_many({})
+    return counts
+
+
+async def read_rollups(kind: str, start: Optional[str], end: Optional[str]) -> RollupReport:
+    # buckets emptied by deletes stay behind with count 0
+    query = {"kind": kind, "count": {"$gt": 0}}
+    if start or end:
+        query["key"] = {}
+        if start:
+            query["key"]["$gte"] = start
+        if end:
+            query["key"]["$lte"] = end
+    buckets = await rollup_reads.find(query, {"_id": 0, "key": 1, "count": 1, "amount": 1}, sort=[("key", ASCENDING)]).to_list(None)
+    return RollupReport(kind=kind, buckets=buckets)
+
+
+@router.get("/daily", response_description="Invoice count and amount per IST day", response_model=RollupReport)
+@check_roles(["admin", "HR"])
+async def daily_report(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    current_user: dict = Depends(get_current_user),
+):
+    return await read_rollups("day", start, end)
+
+
+@router.get("/monthly", response_description="Invoice count and amount per IST month", response_model=RollupReport)
+@check_roles(["admin", "HR"])
+async def monthly_report(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    current_user: dict = Depends(get_current_user),
+):
+    return await read_rollups("month", start, end)
+
+
+@router.get("/by_email", response_description="Invoice count and amount per customer email", response_model=RollupReport)
+@check_roles(["admin", "HR"])
+async def email_report(email: Optional[EmailStr] = None, current_user: dict = Depends(get_current_user)):
+    return await read_rollups("email", email, email)
+
+
+@router.post("/rebuild", response_description="Recompute all rollups from invoices")
+@check_roles(["admin"])
+async def rebuild(current_user: dict = Depends(get_current_user)):
+    return {"message": "Rollups rebuilt", "buckets": await rebuild_rollups()}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m routers.reports rebuild")
+    counts = asyncio.run(rebuild_rollups())
+    print(f"Rebuilt rollups: {counts}")
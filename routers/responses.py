@@ -0,0 +1,83 @@
+import json
+from datetime import datetime
+from bson import ObjectId
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, msgpack requests are answered with JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+BSON_MEDIA_TYPE = "application/bson"
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MongoJSONResponse(JSONResponse):
+    '''Renders Mongo documents (ObjectId, datetime) without a Pydantic round trip'''
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+class MsgPackResponse(Response):
+    '''Same document shape as MongoJSONResponse, encoded as MessagePack'''
+    media_type = MSGPACK_MEDIA_TYPES[0]
+
+    def render(self, content) -> bytes:
+        return msgpack.packb(content, default=_default, use_bin_type=True)
+
+
+class BSONResponse(Response):
+    '''Raw BSON bytes, one document or several concatenated (read with bson.decode_all)'''
+    media_type = BSON_MEDIA_TYPE
+
+
+def accept_ranges(accept: str) -> list:
+    '''(media_type, q) for each entry of an Accept header, highest q first; ties keep header order'''
+    ranges = []
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((media_type.lower(), q))
+    return sorted(ranges, key=lambda entry: -entry[1])
+
+
+def negotiate(accept: str) -> str:
+    '''"bson", "msgpack" or "json": the supported type the Accept header prefers; q=0 means not acceptable'''
+    ranges = accept_ranges(accept)
+    refused = {media_type for media_type, q in ranges if q <= 0}
+    for media_type, q in ranges:
+        if q <= 0:
+            break
+        if media_type == BSON_MEDIA_TYPE:
+            return "bson"
+        if media_type in MSGPACK_MEDIA_TYPES and msgpack is not None:
+            return "msgpack"
+        if media_type in ("application/json", "*/*", "application/*") and "application/json" not in refused:
+            return "json"
+    return "json"
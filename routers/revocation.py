@@ -0,0 +1,64 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from decouple import config
+
+from database import invoicedb as db
+
+# Revoked token ids (jti) for the stateless token auth mode.
+# Logout writes the jti to Mongo and to this worker's in-memory map; other
+# workers pick it up on their next sync, so a revoked token can stay usable
+# elsewhere for at most REVOCATION_SYNC_SECONDS. Entries are dropped once the
+# token would have expired anyway, which keeps the map as small as the number
+# of logouts inside one token lifetime.
+
+revoked_collection = db.get_collection("revoked_tokens")
+
+REVOCATION_SYNC_SECONDS = config('REVOCATION_SYNC_SECONDS', cast=int, default=30)
+
+
+class RevocationList:
+    def __init__(self):
+        self._revoked = {}  # jti -> expires_at (naive UTC)
+        self._synced_at = None
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def _prune(self):
+        now = datetime.utcnow()
+        for jti in [jti for jti, expires_at in self._revoked.items() if expires_at < now]:
+            del self._revoked[jti]
+
+    async def revoke(self, jti: str, expires_at: datetime):
+        expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+        self._revoked[jti] = expires_at
+        await revoked_collection.update_one(
+            {"jti": jti},
+            {"$set": {"expires_at": expires_at, "revoked_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    async def sync(self):
+        now = datetime.utcnow()
+        query = {"expires_at": {"$gt": now}}
+        if self._synced_at is not None:
+            # small overlap so writes racing with the previous sync aren't missed
+            query["revoked_at"] = {"$gte": self._synced_at - timedelta(seconds=5)}
+        async for doc in revoked_collection.find(query, {"_id": 0, "jti": 1, "expires_at": 1}):
+            self._revoked[doc["jti"]] = doc["expires_at"]
+        self._synced_at = now
+        self._prune()
+
+    async def run(self, interval: int = REVOCATION_SYNC_SECONDS):
+        while True:
+            try:
+                await self.sync()
+            except Exception as exc:
+                print(f"Revocation sync failed: {exc}")
+            await asyncio.sleep(interval)
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+revocation_list = RevocationList()
@@ -0,0 +1,100 @@
+import re
+from datetime import datetime
+from decouple import config
+from fastapi import HTTPException, status
+from pymongo import ASCENDING, DESCENDING
+from typing import Optional
+
+# Query planning for filtered invoice listings. Every query is sent with a
+# hint naming one of the indexes below (see MANAGED_INDEXES in database.py),
+# so Mongo can never fall back to a collection scan.
+#
+# A limited listing (at most 1000 invoices) uses the index of its most
+# selective filter and sorts the top matches in memory, which is cheap:
+#
+#   email given              -> email_created_at    (email, created_at, _id)
+#   name_prefix given        -> name_created_at     (name, created_at, _id)
+#   amount range given       -> amount_filters      (amount, _id, created_at, name)
+#
+# A streamed listing has no limit, and sorting all its matches in memory fails
+# past 100MB. Unless it filters by email (one customer's invoices), it walks an
+# index in the requested order and checks the name and amount filters on the
+# index entries:
+#
+#   sorting by amount        -> amount_filters      (amount, _id, created_at, name)
+#   name_prefix or amount
+#   range given              -> created_at_filters  (created_at, _id, name, amount)
+#
+# Anything else walks created_at_id (created_at, _id). Queries that still
+# have to walk too much of an index are stopped after SEARCH_MAX_TIME_MS and
+# answered with a 400 asking for narrower filters.
+
+SEARCH_MAX_TIME_MS = config('SEARCH_MAX_TIME_MS', cast=int, default=2000)
+NAME_PREFIX_MIN_LENGTH = config('NAME_PREFIX_MIN_LENGTH', cast=int, default=2)
+
+SORTS = {
+    "-created_at": [("created_at", DESCENDING), ("_id", DESCENDING)],
+    "created_at": [("created_at", ASCENDING), ("_id", ASCENDING)],
+    "-amount": [("amount", DESCENDING), ("_id", DESCENDING)],
+    "amount": [("amount", ASCENDING), ("_id", ASCENDING)],
+}
+SORT_PATTERN = "^(" + "|".join(re.escape(sort) for sort in SORTS) + ")$"
+
+TOO_BROAD = "Query too broad: add an email, name_prefix, amount or created_at filter to narrow it"
+
+
+def bounds(low, high, upper: str, names: tuple) -> dict:
+    if low is not None and high is not None and low > high:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{names[0]} must not be greater than {names[1]}",
+        )
+    condition = {}
+    if low is not None:
+        condition["$gte"] = low
+    if high is not None:
+        condition[upper] = high
+    return condition
+
+
+def plan_search(
+    email: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    sort: str = "-created_at",
+    streamed: bool = False,
+) -> dict:
+    '''Returns {"query", "sort", "hint"} for the given filters, or raises a 400'''
+    query = {}
+    if email:
+        query["email"] = email
+    if name_prefix is not None:
+        if len(name_prefix) < NAME_PREFIX_MIN_LENGTH:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"name_prefix needs at least {NAME_PREFIX_MIN_LENGTH} characters",
+            )
+        # an anchored, case-sensitive regex becomes index bounds on name
+        query["name"] = {"$regex": "^" + re.escape(name_prefix)}
+    # amount bounds are inclusive, created_to is exclusive like the export's
+    if amount := bounds(min_amount, max_amount, "$lte", ("min_amount", "max_amount")):
+        query["amount"] = amount
+    if created := bounds(created_from, created_to, "$lt", ("created_from", "created_to")):
+        query["created_at"] = created
+
+    if email:
+        hint = "email_created_at"
+    elif name_prefix is not None and not streamed:
+        hint = "name_created_at"
+    elif amount and not streamed:
+        hint = "amount_filters"
+    elif sort.endswith("amount"):
+        hint = "amount_filters"
+    elif name_prefix is not None or amount:
+        hint = "created_at_filters"
+    else:
+        hint = "created_at_id"
+    return {"query": query, "sort": SORTS[sort], "hint": hint}
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from decouple import config
+
+# Bounded LRU cache of session documents keyed by session_id, so authenticated
+# requests don't have to read the sessions collection every time.
+# Each worker has its own cache: a logout handled by another worker is only
+# seen here once the entry's TTL runs out, so keep SESSION_CACHE_TTL short.
+
+SESSION_CACHE_SIZE = config('SESSION_CACHE_SIZE', cast=int, default=10000)
+SESSION_CACHE_TTL = config('SESSION_CACHE_TTL', cast=int, default=60)  # seconds
+
+
+class SessionCache:
+    def __init__(self, maxsize: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id: str):
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            session, cached_at = entry
+            if time.monotonic() - cached_at < self.ttl:
+                self._entries.move_to_end(session_id)
+                self.hits += 1
+                return session
+            del self._entries[session_id]
+        self.misses += 1
+        return None
+
+    def put(self, session_id: str, session: dict):
+        if self.maxsize <= 0:
+            return
+        self._entries[session_id] = (session, time.monotonic())
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_id: str):
+        self._entries.pop(session_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+session_cache = SessionCache()
@@ -1,58 +1,104 @@
-import os
-import asyncio
 from fastapi import Depends, HTTPException, Security,Cookie,status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError,jwt
 from decouple import config
 from typing import Optional,Union,List
-import subprocess
 from functools import wraps
+import time
 from datetime import datetime, timedelta, timezone
 
 
 from database import invoicedb as db,MONGODB_URL
+from routers.session_cache import session_cache
+from routers.revocation import revocation_list
+from metrics import SESSION_LOOKUP_LATENCY
 session_collection = db.get_collection("sessions")
 
 SECRET_KEY = config('SECRET_KEY')
 ALGORITHM = config('ALGORITHM',default = "HS256")
+# "session": sessions collection lookup per request (default)
+# "token": short-lived signed token carrying username and roles, checked without Mongo
+AUTH_MODE = config('AUTH_MODE', default="session")
+TOKEN_EXPIRE_MINUTES = config('TOKEN_EXPIRE_MINUTES', cast=int, default=15)
+SESSION_LIFETIME_MINUTES = config('SESSION_LIFETIME_MINUTES', cast=int, default=30)
+# extend expires_at in Mongo only when less than this is left
+SESSION_REFRESH_THRESHOLD_MINUTES = config('SESSION_REFRESH_THRESHOLD_MINUTES', cast=int, default=20)
 
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)):
+def decode_access_token(token: str) -> dict:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if not username:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-        return username
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.InvalidTokenError:
+    except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return payload
+
+def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)):
+    return decode_access_token(credentials.credentials)["sub"]
     
 
 
-async def get_current_user(session_id: str = Cookie(None)):
+def user_from_token(token: str) -> dict:
+    # stateless mode: signature, expiry and revocation are all checked in memory
+    payload = decode_access_token(token)
+    if payload.get("jti") and revocation_list.is_revoked(payload["jti"]):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+    return {
+        "session_id": payload.get("jti"),
+        "username": payload["sub"],
+        "email": payload.get("email"),
+        "roles": payload.get("roles", []),
+        "expires_at": datetime.utcfromtimestamp(payload["exp"]),
+    }
+
+
+async def get_current_user(
+    session_id: str = Cookie(None),
+    access_token: str = Cookie(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Security(optional_security),
+):
+    start = time.perf_counter()
+    if AUTH_MODE == "token":
+        token = credentials.credentials if credentials else access_token
+        if token:
+            user = user_from_token(token)
+            SESSION_LOOKUP_LATENCY.labels("token").observe(time.perf_counter() - start)
+            return user
+
     if not session_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    session = await session_collection.find_one({"session_id": session_id})
-    if not session:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session not found")
-    
-
-    if session["expires_at"] < datetime.utcnow():
+    source = "cache"
+    session = session_cache.get(session_id)
+    if session is None:
+        source = "mongo"
+        session = await session_collection.find_one({"session_id": session_id})
+        if not session:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session not found")
+        session_cache.put(session_id, session)
+
+    now = datetime.utcnow()
+    if session["expires_at"] < now:
+        session_cache.invalidate(session_id)
         await session_collection.delete_one({"session_id": session_id})
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session expired")
     
-    # Extend session expiration and   /// role update
-    await session_collection.update_one(
-        {"session_id": session_id},
-        {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(minutes=30)}}
-    )
+    # Sliding expiration, only written back once the remaining lifetime gets short
+    if session["expires_at"] - now < timedelta(minutes=SESSION_REFRESH_THRESHOLD_MINUTES):
+        expires_at = now + timedelta(minutes=SESSION_LIFETIME_MINUTES)
+        await session_collection.update_one(
+            {"session_id": session_id},
+            {"$set": {"expires_at": expires_at.replace(tzinfo=timezone.utc)}}
+        )
+        session["expires_at"] = expires_at
     
+    SESSION_LOOKUP_LATENCY.labels(source).observe(time.perf_counter() - start)
     return session
 
 
@@ -73,48 +119,3 @@ def check_roles(required_roles: List[str]):
             return await func(*args, **kwargs)
         return wrapper
     return decorator
-
-
-
-
-# set in cron job
-async def create_backup():
-    # Set your MongoDB connection details
-    db_name = db.name
-    
-    # Set the output directory to fast-api-backend/backups
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    backup_dir = os.path.join(base_dir, 'backups')
-    os.makedirs(backup_dir, exist_ok=True)  
-
-    # Create a timestamp for the backup file
-    utc_time = datetime.now(timezone.utc)
-    ist_time = utc_time + timedelta(hours=5, minutes=30)
-    timestamp = ist_time.strftime("%d-%m-%Y_%H-%M-%S")
-    backup_file = f"{db_name}_{timestamp}.gz"
-    backup_path = os.path.join(backup_dir, backup_file)
-
-
-    cmd = f"mongodump --uri=\"{MONGODB_URL}\" --db {db_name} --gzip --archive={backup_path}"
-
-    # Execute the command
-    try:
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode == 0:
-            print(f"Backup created successfully: {backup_file}")
-            return {"status": "success", "file": backup_file}
-        else:
-            error_msg = stderr.decode()
-            print(f"Backup failed: {error_msg}")
-            raise HTTPException(status_code=500, detail=f"Backup failed: {error_msg}")
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Backup failed: {error_msg}")
-        raise HTTPException(status_code=500, detail=f"Backup failed: {error_msg}")
-    
\ No newline at end of file
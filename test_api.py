@@ -1,83 +1,93 @@
-from requests import get, post, put, delete, HTTPError
+import pytest
+from httpx import Client, HTTPStatusError
 
+from benchmarks.harness import FAKE_PASSWORD, mongo_available, stack
 
-def test_api():
+
+@pytest.fixture(scope="module")
+def client():
+    if not mongo_available():
+        pytest.skip("needs mongod on PATH or BENCH_MONGODB_URL")
+    with stack() as base_url, Client(base_url=base_url) as client:
+        yield client
+
+
+def test_api(client):
     """
     An automated version of the manual testing I've been doing,
-    testing the lifecycle of an inserted document.
+    testing the lifecycle of an inserted invoice against a throwaway
+    Mongo and a fake Frappe (see benchmarks/harness.py).
     """
-    student_root = "http://localhost:8000/students/"
+    invoice_root = "/api/invoices/"
 
     initial_doc = {
-        "course": "Test Course",
-        "email": "jdoe_test@example.com",
-        "gpa": "3.0",
         "name": "Jane Doe",
+        "email": "jdoe_test@example.com",
+        "amount": 300.0,
     }
 
     try:
-        # Insert a student
-        response = post(student_root, json=initial_doc)
+        # Unauthenticated requests are refused
+        response = client.get(invoice_root + "get_pagination")
+        assert response.status_code == 401
+
+        # Log in through the fake Frappe, the session cookie is kept by the client
+        response = client.post("/api/auth/", data={"username": "jdoe", "password": "wrong"})
+        assert response.status_code == 401
+        response = client.post("/api/auth/", data={"username": "jdoe", "password": FAKE_PASSWORD})
         response.raise_for_status()
+
+        # Insert an invoice
+        response = client.post(invoice_root, json=initial_doc)
+        assert response.status_code == 201
         doc = response.json()
-        inserted_id = doc["id"]
-        print(f"Inserted document with id: {inserted_id}")
-        print(
-            "If the test fails in the middle you may want to manually remove the document."
-        )
-        assert doc["course"] == "Test Course"
-        assert doc["email"] == "jdoe_test@example.com"
-        assert doc["gpa"] == 3.0
+        invoice_number = doc["invoice_number"]
+        print(f"Inserted invoice {invoice_number}")
+        assert invoice_number.startswith("INV-")
         assert doc["name"] == "Jane Doe"
+        assert doc["email"] == "jdoe_test@example.com"
+        assert doc["amount"] == 300.0
 
-        # List students and ensure it's present
-        response = get(student_root)
+        # List invoices and ensure it's present
+        response = client.get(invoice_root)
         response.raise_for_status()
-        student_ids = {s["id"] for s in response.json()["students"]}
-        assert inserted_id in student_ids
+        numbers = {i["invoice_number"] for i in response.json()["invoices"]}
+        assert invoice_number in numbers
 
-        # Get individual student doc
-        response = get(student_root + inserted_id)
+        # Get individual invoice, then again with its ETag
+        response = client.get(invoice_root + invoice_number)
         response.raise_for_status()
-        doc = response.json()
-        assert doc["id"] == inserted_id
-        assert doc["course"] == "Test Course"
-        assert doc["email"] == "jdoe_test@example.com"
-        assert doc["gpa"] == 3.0
-        assert doc["name"] == "Jane Doe"
+        assert response.json() == doc
+        etag = response.headers["ETag"]
+        response = client.get(invoice_root + invoice_number, headers={"If-None-Match": etag})
+        assert response.status_code == 304
 
-        # Update the student doc
-        response = put(
-            student_root + inserted_id,
-            json={
-                "email": "updated_email@example.com",
-            },
-        )
+        # Update the invoice
+        response = client.put(invoice_root + invoice_number, json={"email": "updated_email@example.com"})
         response.raise_for_status()
         doc = response.json()
-        assert doc["id"] == inserted_id
-        assert doc["course"] == "Test Course"
+        assert doc["invoice_number"] == invoice_number
         assert doc["email"] == "updated_email@example.com"
-        assert doc["gpa"] == 3.0
-        assert doc["name"] == "Jane Doe"
+        assert doc["amount"] == 300.0
+        assert response.headers["ETag"] != etag
 
-        # Get the student doc and check for change
-        response = get(student_root + inserted_id)
+        # Get the invoice and check for change
+        response = client.get(invoice_root + invoice_number)
         response.raise_for_status()
-        doc = response.json()
-        assert doc["id"] == inserted_id
-        assert doc["course"] == "Test Course"
-        assert doc["email"] == "updated_email@example.com"
-        assert doc["gpa"] == 3.0
-        assert doc["name"] == "Jane Doe"
+        assert response.json() == doc
+
+        # It shows up on the first page of the keyset pagination
+        response = client.get(invoice_root + "get_pagination", params={"limit": 10})
+        response.raise_for_status()
+        assert invoice_number in {i["invoice_number"] for i in response.json()["invoices"]}
 
-        # Delete the doc
-        response = delete(student_root + inserted_id)
+        # Delete the invoice
+        response = client.delete(invoice_root + invoice_number)
         response.raise_for_status()
 
-        # Get the doc and ensure it's been deleted
-        response = get(student_root + inserted_id)
+        # Get the invoice and ensure it's been deleted
+        response = client.get(invoice_root + invoice_number)
         assert response.status_code == 404
-    except HTTPError as he:
+    except HTTPStatusError as he:
         print(he.response.json())
         raise
@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import routers.auth.auth as auth
+import routers.backup as backup
+from routers.auth.auth import parse_byte_range
+
+
+def test_byte_range_suffix():
+    assert parse_byte_range("bytes=-100", 1000) == (900, 999)
+    assert parse_byte_range("bytes=-5000", 1000) == (0, 999)
+
+
+def test_byte_range_open_ended():
+    assert parse_byte_range("bytes=200-", 1000) == (200, 999)
+    assert parse_byte_range("bytes=200-5000", 1000) == (200, 999)
+
+
+def test_byte_range_multiple_ranges_send_whole_file():
+    assert parse_byte_range("bytes=0-10,20-30", 1000) is None
+
+
+def test_byte_range_inverted_is_ignored():
+    assert parse_byte_range("bytes=500-100", 1000) is None
+
+
+def test_byte_range_unusable_headers_are_ignored():
+    assert parse_byte_range("items=0-10", 1000) is None
+    assert parse_byte_range("bytes=a-b", 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=-0"])
+def test_byte_range_not_satisfiable(header):
+    with pytest.raises(HTTPException) as exc:
+        parse_byte_range(header, 1000)
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == "bytes */1000"
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmp_path))
+    monkeypatch.setattr(auth, "BACKUP_DIR", str(tmp_path))
+    catalog = backup.BackupCatalog()
+    monkeypatch.setattr(auth, "backup_catalog", catalog)
+    data = bytes(range(256)) * 4
+    (tmp_path / "a.gz").write_bytes(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    catalog.add({"file": "a.gz", "size": len(data), "sha256": sha256, "created_at": "2024-01-01T00:00:00", "type": "full", "parent": None})
+    return catalog, sha256
+
+
+def download(headers: dict):
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]}
+    return asyncio.run(auth.download_backup("a.gz", Request(scope)))
+
+
+def test_range_download_with_matching_if_range(archive):
+    _, sha256 = archive
+    response = download({"Range": "bytes=1000-", "If-Range": f'"{sha256}"'})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 1000-1023/1024"
+
+
+def test_if_range_mismatch_sends_whole_file(archive):
+    response = download({"Range": "bytes=1000-", "If-Range": '"0123"'})
+    assert response.status_code == 200
+    assert "Content-Range" not in response.headers
+
+
+def test_catalog_reloads_when_another_worker_records(archive):
+    catalog, _ = archive
+    other_worker = backup.BackupCatalog()
+    assert other_worker.get("a.gz") is not None
+    catalog.add({"file": "b.gz", "size": 1, "sha256": "00", "created_at": "2024-01-02T00:00:00", "type": "full", "parent": None})
+    assert [entry["file"] for entry in other_worker.entries()] == ["b.gz", "a.gz"]
+    # a record from the stale copy keeps the entry it never saw
+    other_worker.add({"file": "c.gz", "size": 1, "sha256": "00", "created_at": "2024-01-03T00:00:00", "type": "full", "parent": None})
+    assert set(catalog.load()) == {"a.gz", "b.gz", "c.gz"}
@@ -0,0 +1,116 @@
+import pytest
+
+from routers.auth import breaker
+from routers.auth.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, RetryBudget
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(breaker, "time", clock)
+    return clock
+
+
+def new_breaker(**kwargs):
+    settings = dict(window=10, min_calls=4, error_rate=0.5, slow_seconds=1, slow_rate=0.5, open_seconds=30, probes=2)
+    settings.update(kwargs)
+    return CircuitBreaker(**settings)
+
+
+def call(circuit, ok=True, elapsed=0.01):
+    probe = circuit.before_call()
+    circuit.record(probe, ok, elapsed)
+    return probe
+
+
+def test_opens_once_the_error_rate_is_reached(clock):
+    circuit = new_breaker()
+    call(circuit, ok=False)
+    call(circuit, ok=False)
+    call(circuit)
+    assert circuit.state == CLOSED  # under min_calls
+    call(circuit, ok=False)
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpen) as exc:
+        circuit.before_call()
+    assert exc.value.retry_after == pytest.approx(30)
+
+
+def test_opens_on_slow_calls(clock):
+    circuit = new_breaker()
+    for _ in range(4):
+        call(circuit, elapsed=2)
+    assert circuit.state == OPEN
+    assert "took over" in circuit.reason
+
+
+def test_old_failures_leave_the_window(clock):
+    circuit = new_breaker()
+    for _ in range(3):
+        call(circuit, ok=False)
+    clock.now += 11
+    call(circuit, ok=False)
+    assert circuit.state == CLOSED
+    assert circuit.snapshot()["calls"] == 1
+
+
+def test_half_open_probes_close_it(clock):
+    circuit = new_breaker()
+    for _ in range(4):
+        call(circuit, ok=False)
+    clock.now += 31
+    first, second = circuit.before_call(), circuit.before_call()
+    assert first and second and circuit.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        circuit.before_call()  # only `probes` calls at a time
+    circuit.record(first, True, 0.01)
+    circuit.record(second, True, 0.01)
+    assert circuit.state == CLOSED
+    # closing starts a fresh window
+    assert circuit.snapshot()["calls"] == 0
+    assert call(circuit) is False
+
+
+def test_failed_probe_reopens_it(clock):
+    circuit = new_breaker()
+    for _ in range(4):
+        call(circuit, ok=False)
+    clock.now += 31
+    assert call(circuit, ok=False) is True
+    assert circuit.state == OPEN
+    assert circuit.snapshot()["retry_after"] == pytest.approx(30)
+
+
+def test_cancelled_probe_frees_its_slot(clock):
+    circuit = new_breaker(probes=1)
+    for _ in range(4):
+        call(circuit, ok=False)
+    clock.now += 31
+    circuit.cancelled(circuit.before_call())
+    assert call(circuit) is True
+    assert circuit.state == CLOSED
+
+
+def test_retry_budget_is_exhausted(clock):
+    budget = RetryBudget(ratio=0.1, min_per_second=0.2, window=10)  # 2 retries in reserve
+    for _ in range(20):
+        budget.request()
+    allowed = sum(budget.try_retry() for _ in range(10))
+    assert allowed == 4  # 0.1 * 20 + 2
+    assert not budget.try_retry()
+
+
+def test_retry_budget_refills_as_the_window_moves(clock):
+    budget = RetryBudget(ratio=0.1, min_per_second=0.1, window=10)
+    assert budget.try_retry()
+    assert not budget.try_retry()
+    clock.now += 10
+    assert budget.try_retry()
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError, WriteError
+
+from routers import coalescer
+from routers.coalescer import CreateCoalescer
+
+
+class FakeInvoices:
+    def __init__(self, duplicate_emails=()):
+        self.batches = []
+        self.duplicate_emails = set(duplicate_emails)
+
+    async def insert_many(self, docs, ordered=True):
+        self.batches.append([doc["email"] for doc in docs])
+        errors = [
+            {"index": index, "code": 11000, "errmsg": f"duplicate key {doc['email']}"}
+            for index, doc in enumerate(docs) if doc["email"] in self.duplicate_emails
+        ]
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(docs) - len(errors)})
+
+
+class FakeAllocator:
+    def __init__(self):
+        self.next = 1
+
+    async def take(self, count):
+        numbers = [f"INV-{number}" for number in range(self.next, self.next + count)]
+        self.next += count
+        return numbers
+
+
+@pytest.fixture
+def invoices(monkeypatch):
+    invoices = FakeInvoices(duplicate_emails={"dup@example.com"})
+    monkeypatch.setattr(coalescer, "invoice_collection", invoices)
+    monkeypatch.setattr(coalescer, "allocator", FakeAllocator())
+
+    async def apply_rollup_deltas(docs):
+        pass
+    monkeypatch.setattr(coalescer, "apply_rollup_deltas", apply_rollup_deltas)
+    return invoices
+
+
+def submit_all(create_coalescer, emails):
+    async def run():
+        return await asyncio.gather(
+            *(create_coalescer.submit({"email": email}) for email in emails),
+            return_exceptions=True,
+        )
+    return asyncio.run(run())
+
+
+def test_creates_within_the_window_share_a_batch(invoices):
+    results = submit_all(CreateCoalescer(window_ms=50, max_batch=100), ["a@example.com", "b@example.com", "c@example.com"])
+    assert invoices.batches == [["a@example.com", "b@example.com", "c@example.com"]]
+    assert [doc["invoice_number"] for doc in results] == ["INV-1", "INV-2", "INV-3"]
+
+
+def test_max_batch_flushes_before_the_window(invoices):
+    async def run():
+        create_coalescer = CreateCoalescer(window_ms=60_000, max_batch=2)
+        # a full batch must not wait for the (one minute) window
+        return await asyncio.wait_for(
+            asyncio.gather(*(create_coalescer.submit({"email": f"{n}@example.com"}) for n in range(4))),
+            timeout=1,
+        )
+    results = asyncio.run(run())
+    assert invoices.batches == [["0@example.com", "1@example.com"], ["2@example.com", "3@example.com"]]
+    assert len(results) == 4
+
+
+def test_rejected_document_fails_only_its_caller(invoices):
+    results = submit_all(CreateCoalescer(window_ms=50), ["a@example.com", "dup@example.com", "c@example.com"])
+    first, duplicate, last = results
+    assert first["email"] == "a@example.com" and last["email"] == "c@example.com"
+    assert isinstance(duplicate, WriteError)
+    assert duplicate.code == 11000
+    assert "dup@example.com" in str(duplicate)
+
+
+def test_drain_flushes_waiting_creates(invoices):
+    async def run():
+        create_coalescer = CreateCoalescer(window_ms=60_000)
+        pending = asyncio.create_task(create_coalescer.submit({"email": "a@example.com"}))
+        await asyncio.sleep(0)
+        await create_coalescer.drain()
+        return await pending
+    assert asyncio.run(run())["invoice_number"] == "INV-1"
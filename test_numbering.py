@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from routers import numbering
+from routers.numbering import InvoiceNumberAllocator
+
+
+class FakeCounters:
+    def __init__(self):
+        self.seq = {}
+        self.calls = []
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        self.calls.append(update["$inc"]["seq"])
+        self.seq[query["_id"]] = self.seq.get(query["_id"], 0) + update["$inc"]["seq"]
+        return {"_id": query["_id"], "seq": self.seq[query["_id"]]}
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    counters = FakeCounters()
+    monkeypatch.setattr(numbering, "counter_collection", counters)
+    monkeypatch.setattr(numbering, "ist_date_string", lambda: "01-01-2024")
+    return counters
+
+
+def sequence(numbers):
+    return [int(number.rsplit("-", 1)[1]) for number in numbers]
+
+
+def test_small_batches_are_served_from_the_block(counters):
+    async def run():
+        allocator = InvoiceNumberAllocator(block_size=10)
+        batches = [await allocator.take(1), await allocator.take(3), [await allocator.next_number()]]
+        return batches
+    assert [sequence(batch) for batch in asyncio.run(run())] == [[1], [2, 3, 4], [5]]
+    assert counters.calls == [10]
+
+
+def test_a_batch_past_the_block_tops_it_up_once(counters):
+    async def run():
+        allocator = InvoiceNumberAllocator(block_size=10)
+        first = await allocator.take(8)
+        # another worker reserves in between
+        await numbering.counter_collection.find_one_and_update({"_id": "invoice:01-01-2024"}, {"$inc": {"seq": 10}})
+        return first, await allocator.take(25), await allocator.take(1)
+    first, second, third = asyncio.run(run())
+    assert sequence(first) == list(range(1, 9))
+    assert sequence(second) == [9, 10] + list(range(21, 44))
+    assert sequence(third) == [44]
+    assert counters.calls == [10, 10, 23, 10]
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from routers.invoice import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    invoice = {"_id": ObjectId("65a1b2c3d4e5f60718293a4b"), "created_at": datetime(2024, 1, 12, 9, 30, 15, 123000)}
+    cursor = encode_cursor(invoice)
+    assert "=" not in cursor  # padding is stripped, the cursor goes in a query string
+    assert decode_cursor(cursor) == {"$or": [
+        {"created_at": {"$lt": invoice["created_at"]}},
+        {"created_at": invoice["created_at"], "_id": {"$lt": invoice["_id"]}},
+    ]}
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "eyJ0IjogIngifQ", encode_cursor({"_id": "nope", "created_at": datetime(2024, 1, 1)})])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(cursor)
+    assert exc.value.status_code == 400
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+
+from routers.pdf import PART_MAX_AGE_SECONDS, PdfCache
+
+
+def store(cache: PdfCache, name: str, size: int, age: float = 0):
+    part_path = cache.part_path(name)
+    with open(part_path, "wb") as f:
+        f.write(b"%" * size)
+    asyncio.run(cache.store(name, part_path))
+    if age:
+        used = time.time() - age
+        os.utime(cache.path(name), (used, used))
+
+
+def test_other_workers_serve_a_stored_pdf(tmp_path):
+    this_worker, other_worker = PdfCache(str(tmp_path)), PdfCache(str(tmp_path))
+    this_worker.load()
+    other_worker.load()
+    name = PdfCache.key("INV-1", 0, "Standard")
+    assert other_worker.get(name) is None
+    store(this_worker, name, 10)
+    assert other_worker.get(name) == os.path.join(str(tmp_path), name)
+
+
+def test_new_revision_replaces_the_old_one(tmp_path):
+    cache = PdfCache(str(tmp_path))
+    cache.load()
+    store(cache, PdfCache.key("INV-1", 0, "Standard"), 10)
+    store(cache, PdfCache.key("INV-10", 0, "Standard"), 10)
+    store(cache, PdfCache.key("INV-1", 1, "Standard"), 10)
+    assert sorted(os.listdir(tmp_path)) == ["INV-1--r1--Standard.pdf", "INV-10--r0--Standard.pdf"]
+
+
+def test_eviction_counts_every_worker_s_files(tmp_path):
+    this_worker, other_worker = PdfCache(str(tmp_path), max_bytes=350), PdfCache(str(tmp_path), max_bytes=350)
+    store(other_worker, "A--r0--Standard.pdf", 100, age=30)
+    store(other_worker, "B--r0--Standard.pdf", 100, age=20)
+    store(this_worker, "C--r0--Standard.pdf", 100, age=10)
+    assert this_worker.get("A--r0--Standard.pdf") is not None  # used again, B is now the oldest
+    store(this_worker, "D--r0--Standard.pdf", 100)
+    assert sorted(os.listdir(tmp_path)) == ["A--r0--Standard.pdf", "C--r0--Standard.pdf", "D--r0--Standard.pdf"]
+
+
+def test_a_pdf_larger_than_the_cache_is_kept_until_the_next_store(tmp_path):
+    cache = PdfCache(str(tmp_path), max_bytes=50)
+    store(cache, "A--r0--Standard.pdf", 100)
+    assert os.listdir(tmp_path) == ["A--r0--Standard.pdf"]
+
+
+def test_load_clears_only_abandoned_downloads(tmp_path):
+    cache = PdfCache(str(tmp_path))
+    abandoned, in_progress = cache.part_path("A--r0--Standard.pdf"), cache.part_path("B--r0--Standard.pdf")
+    for path in (abandoned, in_progress):
+        open(path, "wb").close()
+    old = time.time() - PART_MAX_AGE_SECONDS - 1
+    os.utime(abandoned, (old, old))
+    cache.load()
+    assert os.listdir(tmp_path) == [os.path.basename(in_progress)]
+
+
+def test_other_print_formats_are_kept(tmp_path):
+    cache = PdfCache(str(tmp_path))
+    store(cache, PdfCache.key("INV-1", 0, "Standard"), 10)
+    store(cache, PdfCache.key("INV-1", 1, "GST Invoice"), 10)
+    assert sorted(os.listdir(tmp_path)) == ["INV-1--r0--Standard.pdf", "INV-1--r1--GST_Invoice.pdf"]
+
+
+def test_a_slow_download_of_an_older_revision_is_dropped(tmp_path):
+    cache = PdfCache(str(tmp_path))
+    slow_part = cache.part_path(PdfCache.key("INV-1", 1, "Standard"))
+    with open(slow_part, "wb") as f:
+        f.write(b"old")
+    store(cache, PdfCache.key("INV-1", 2, "Standard"), 10)
+    asyncio.run(cache.store(PdfCache.key("INV-1", 1, "Standard"), slow_part))
+    assert os.listdir(tmp_path) == ["INV-1--r2--Standard.pdf"]
+
+
+def test_a_newer_revision_stored_concurrently_wins(tmp_path):
+    cache = PdfCache(str(tmp_path))
+    # published by another worker between this worker's check and its rename
+    (tmp_path / "INV-1--r2--Standard.pdf").write_bytes(b"new")
+    (tmp_path / "INV-1--r1--Standard.pdf").write_bytes(b"old")
+    cache._evict("INV-1--r1--Standard.pdf")
+    assert os.listdir(tmp_path) == ["INV-1--r2--Standard.pdf"]
@@ -0,0 +1,28 @@
+import pytest
+
+from routers import responses
+from routers.responses import negotiate
+
+
+@pytest.mark.parametrize("accept, encoding", [
+    ("", "json"),
+    ("application/bson", "bson"),
+    ("application/json, application/bson", "json"),
+    ("application/json;q=0.5, application/bson", "bson"),
+    ("application/bson;q=0.2, application/json;q=0.9", "json"),
+    ("text/html, */*;q=0.8", "json"),
+    ("application/bson;q=0, */*", "json"),
+    ("application/bson; q=0.0, application/json", "json"),
+    ("application/json;q=0, */*;q=0.5, application/bson;q=0.1", "bson"),
+    ("application/bson;q=abc, application/json", "json"),
+])
+def test_negotiate(accept, encoding):
+    assert negotiate(accept) == encoding
+
+
+def test_negotiate_msgpack():
+    if responses.msgpack is None:
+        assert negotiate("application/msgpack") == "json"
+        return
+    assert negotiate("application/json;q=0.5, application/x-msgpack") == "msgpack"
+    assert negotiate("application/msgpack;q=0, application/json") == "json"
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from routers import revocation
+from routers.revocation import RevocationList
+
+
+class FakeRevokedTokens:
+    '''The few revoked_tokens queries RevocationList makes, in memory'''
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        self.docs[doc["jti"]] = doc
+
+    async def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query["jti"], dict(query)).update(update["$set"])
+
+    async def find(self, query, projection):
+        for doc in list(self.docs.values()):
+            if doc["expires_at"] <= query["expires_at"]["$gt"]:
+                continue
+            if "revoked_at" in query and doc["revoked_at"] < query["revoked_at"]["$gte"]:
+                continue
+            yield {"jti": doc["jti"], "expires_at": doc["expires_at"]}
+
+
+@pytest.fixture
+def revoked(monkeypatch):
+    collection = FakeRevokedTokens()
+    monkeypatch.setattr(revocation, "revoked_collection", collection)
+    return collection
+
+
+def test_sync_overlap_picks_up_a_revoke_racing_the_previous_sync(revoked):
+    async def run():
+        worker = RevocationList()
+        await worker.sync()
+        # another worker's logout stamped just before this worker's sync finished
+        await revoked.insert_one({
+            "jti": "racing",
+            "expires_at": datetime.utcnow() + timedelta(hours=1),
+            "revoked_at": worker._synced_at - timedelta(seconds=2),
+        })
+        await revoked.insert_one({
+            "jti": "long-synced",
+            "expires_at": datetime.utcnow() + timedelta(hours=1),
+            "revoked_at": worker._synced_at - timedelta(minutes=10),
+        })
+        await worker.sync()
+        return worker
+    worker = asyncio.run(run())
+    assert worker.is_revoked("racing")
+    # older than the overlap, a previous sync already had it
+    assert not worker.is_revoked("long-synced")
+
+
+def test_revoke_is_seen_by_other_workers_and_expires(revoked):
+    async def run():
+        this_worker, other_worker = RevocationList(), RevocationList()
+        await other_worker.sync()
+        await this_worker.revoke("jti-1", datetime.now().astimezone() + timedelta(hours=1))
+        await other_worker.sync()
+        seen = other_worker.is_revoked("jti-1")
+        other_worker._revoked["jti-1"] = datetime.utcnow() - timedelta(seconds=1)
+        other_worker._prune()
+        return this_worker.is_revoked("jti-1"), seen, len(other_worker)
+    assert asyncio.run(run()) == (True, True, 0)
@@ -0,0 +1,54 @@
+import pytest
+from fastapi import HTTPException
+
+from database import MANAGED_INDEXES
+from routers.search import SORTS, plan_search
+
+
+def index_keys(name: str) -> list:
+    for index in MANAGED_INDEXES["invoices"]:
+        if index.document["name"] == name:
+            return list(index.document["key"].items())
+    raise AssertionError(f"{name} is not a managed index")
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"name_prefix": "Ja"},
+    {"min_amount": 10},
+    {"name_prefix": "Ja", "max_amount": 500},
+    {"created_from": "2024-01-01"},
+])
+@pytest.mark.parametrize("sort", list(SORTS))
+def test_streamed_listing_walks_an_index_in_sort_order(filters, sort):
+    plan = plan_search(sort=sort, streamed=True, **filters)
+    keys = index_keys(plan["hint"])
+    sort_keys = plan["sort"]
+    # the index starts with the sort keys, walked forwards or backwards
+    assert [field for field, _ in keys[:len(sort_keys)]] == [field for field, _ in sort_keys]
+    directions = {direction * sort_direction for (_, direction), (_, sort_direction) in zip(keys, sort_keys)}
+    assert len(directions) == 1
+
+
+@pytest.mark.parametrize("sort", list(SORTS))
+def test_limited_listing_uses_the_selective_filter_s_index(sort):
+    assert plan_search(name_prefix="Ja", sort=sort)["hint"] == "name_created_at"
+    assert plan_search(name_prefix="Ja", min_amount=10, sort=sort)["hint"] == "name_created_at"
+    assert plan_search(min_amount=10, max_amount=20, sort=sort)["hint"] == "amount_filters"
+    # the name index leads with the filtered field
+    assert index_keys("name_created_at")[0][0] == "name"
+
+
+def test_email_uses_its_own_index():
+    assert plan_search(email="a@example.com", name_prefix="Ja", sort="amount")["hint"] == "email_created_at"
+
+
+def test_name_prefix_is_an_anchored_regex():
+    assert plan_search(name_prefix="J.")["query"] == {"name": {"$regex": r"^J\."}}
+
+
+def test_short_name_prefix_and_inverted_bounds_are_rejected():
+    with pytest.raises(HTTPException):
+        plan_search(name_prefix="J")
+    with pytest.raises(HTTPException):
+        plan_search(min_amount=10, max_amount=5)